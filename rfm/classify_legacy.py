@@ -1,12 +1,12 @@
 from .config.logs import get_logger
 from .config.read_config import read_config
-from .legacy.classify import run_classification
+from .legacy.classify import run_classifications
 
 log = get_logger()
 
 def main(config):
-    job_id = config['job_id']
-    run_classification(job_id)
+    job_ids = config.get('job_ids', [config['job_id']])
+    run_classifications(job_ids)
 
 if __name__ == "__main__":
     log.info('PROCESS: Initialization')
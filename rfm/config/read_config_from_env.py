@@ -6,5 +6,15 @@ def read_config_from_env() -> dict:
 
     if "JOB_ID" in os.environ:
         config['job_id'] = int(os.getenv("JOB_ID", "")) if os.getenv("JOB_ID") is not None else None
-        
+
+    # classification jobs sharing a playlist, run in a single pass
+    if "JOB_IDS" in os.environ:
+        job_ids = [int(j) for j in os.getenv("JOB_IDS", "").split(',') if j.strip()]
+        if len(job_ids) > 0:
+            config['job_ids'] = job_ids
+            if 'job_id' not in config:
+                config['job_id'] = job_ids[0]
+        elif 'job_id' not in config:
+            raise ValueError("JOB_IDS must list at least one job id when JOB_ID is not set")
+
     return config
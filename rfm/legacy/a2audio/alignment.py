@@ -0,0 +1,60 @@
+import numpy
+from scipy.fft import irfft, next_fast_len, rfft
+
+# relative bound on the rounding of the distances computed at once, the offsets within
+# it of the minimum are compared with the exact distances
+TOLERANCE = 1e-9
+
+
+class OffsetSearch:
+    """Finds the offset at which a ROI best fits a reference spectrogram (the biggest ROI of
+    a Roiset), as the minimum of numpy.linalg.norm(window - roi) over the offsets. Every
+    distance is computed at once as ||a||^2 + ||b||^2 - 2a.b, the reference rows being
+    transformed once for the cross terms of all the ROIs."""
+
+    def __init__(self, reference):
+        self.reference = numpy.asarray(reference, dtype=numpy.float64)
+        self.size = next_fast_len(2 * self.reference.shape[1])
+        self.spectrum = rfft(self.reference, self.size, axis=1)
+
+    def distances(self, spec, first, offsets):
+        """Squared distances ||reference[first:(first+rows), j:(j+columns)] - spec||^2 for j
+        in range(offsets), and a bound of their rounding"""
+        rows, columns = spec.shape
+        band = self.reference[first:(first + rows)]
+        squares = numpy.concatenate([[0.0], numpy.cumsum((band * band).sum(axis=0))])
+        window = squares[columns:(columns + offsets)] - squares[:offsets]
+        spec_squares = (spec * spec).sum()
+        # correlation of each row by convolution with the reversed roi, summed over the rows
+        product = (self.spectrum[first:(first + rows)] * rfft(spec[:, ::-1], self.size, axis=1)).sum(axis=0)
+        cross = irfft(product, self.size)[(columns - 1):(columns - 1 + offsets)]
+        return window + spec_squares - 2 * cross, TOLERANCE * (squares[-1] + spec_squares)
+
+    def best_offset(self, spec, first, offsets):
+        """The first j in range(offsets) minimizing
+        numpy.linalg.norm(reference[first:(first+rows), j:(j+columns)] - spec), 0 when offsets
+        is 0. The exact distances are only computed for the offsets too close to the
+        minimum to tell apart, so the result is the one of the loop over every offset"""
+        if offsets <= 0:
+            return 0
+        spec = numpy.asarray(spec, dtype=numpy.float64)
+        rows, columns = spec.shape
+        band = self.reference[first:(first + rows)]
+        distances, bound = self.distances(spec, first, offsets)
+        if numpy.all(numpy.isfinite(distances)):
+            candidates = numpy.flatnonzero(distances <= distances.min() + 2 * bound)
+        else:
+            candidates = numpy.arange(offsets)
+        # windows of zeros all have the distance numpy.linalg.norm(spec), bit for bit
+        nonzero = numpy.concatenate([[0], numpy.cumsum(numpy.any(band != 0, axis=0))])
+        empty = (nonzero[columns:(columns + offsets)] - nonzero[:offsets]) == 0
+        empty_distance = None
+        exact = []
+        for j in candidates:
+            if empty[j]:
+                if empty_distance is None:
+                    empty_distance = numpy.linalg.norm(band[:, j:(j + columns)] - spec)
+                exact.append(empty_distance)
+            else:
+                exact.append(numpy.linalg.norm(band[:, j:(j + columns)] - spec))
+        return int(candidates[exact.index(min(exact))])
@@ -0,0 +1,178 @@
+import numpy
+from functools import lru_cache
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import rfftfreq
+from scipy.signal import get_window
+
+# Number of STFT columns transformed at a time, bounds the temporary frame copies
+CHUNK_COLUMNS = 4096
+
+
+def psd_freqs(nfft, sample_rate):
+    "Frequencies of the rows of mlab.specgram (one-sided, even nfft)"
+    freqs = numpy.fft.fftfreq(nfft, 1/sample_rate)[:nfft//2 + 1]
+    freqs[-1] *= -1
+    return freqs
+
+
+def magnitude_freqs(nfft, sample_rate):
+    "Frequencies of the rows of scipy.signal.spectrogram"
+    return rfftfreq(nfft, 1/sample_rate)
+
+
+def band_rows(freqs, low, high):
+    "Returns (first row at or above low, first row at or above high)"
+    first = int(numpy.searchsorted(freqs, low, side='left'))
+    last = max(first, int(numpy.searchsorted(freqs, high, side='left')))
+    return first, last
+
+
+def stft_columns(data, nfft, noverlap):
+    "Number of columns of a STFT without boundary padding"
+    return (max(len(data), nfft) - nfft) // (nfft - noverlap) + 1
+
+
+@lru_cache(maxsize=64)
+def dft_basis(nfft, window_key, first, last):
+    "Windowed DFT matrix of rows first:last, shape (nfft, last-first)"
+    window = window_of(nfft, window_key)
+    n = numpy.arange(nfft)
+    k = numpy.arange(first, last)
+    basis = window[:, None] * numpy.exp(-2j * numpy.pi * numpy.outer(n, k) / nfft)
+    basis.setflags(write=False)
+    return basis
+
+
+@lru_cache(maxsize=16)
+def window_of(nfft, window_key):
+    if window_key == 'hanning':
+        # mlab.window_hanning
+        window = numpy.hanning(nfft)
+    else:
+        window = get_window(window_key, nfft)
+    window.setflags(write=False)
+    return window
+
+
+def use_direct_dft(nfft, rows):
+    # a band-only DFT (one matrix product) is cheaper than a full FFT per
+    # column when the band has fewer rows than ~2*log2(nfft)
+    return rows <= 2 * int(numpy.log2(nfft))
+
+
+def stft_frames(data, nfft, noverlap):
+    "The frames of a STFT of data (padded to nfft when shorter), as a view"
+    data = numpy.asarray(data)
+    if len(data) < nfft:
+        data = numpy.concatenate([data, numpy.zeros(nfft - len(data), dtype=data.dtype)])
+    return sliding_window_view(data, nfft)[::(nfft - noverlap)]
+
+
+def transform_frames(chunk, nfft, window_key, first, last, detrend, direct):
+    "Rows first:last of the DFT of each frame of chunk, shape (frames, last-first)"
+    if detrend:
+        chunk = chunk - chunk.mean(axis=1, keepdims=True)
+    if direct:
+        return chunk @ dft_basis(nfft, window_key, first, last)
+    return numpy.fft.rfft(chunk * window_of(nfft, window_key), axis=1)[:, first:last]
+
+
+def stft_band(data, nfft, noverlap, window_key, first, last, detrend=False, columns=None):
+    """Complex STFT restricted to the rows first:last, shape (last-first, columns).
+    Only the band is ever materialized: narrow bands are computed with a band-only
+    DFT, wide ones with a real FFT per chunk of columns."""
+    frames = stft_frames(data, nfft, noverlap)
+    if columns is not None:
+        frames = frames[:columns]
+    rows = last - first
+    out = numpy.empty((rows, frames.shape[0]), dtype=numpy.complex128)
+    if rows == 0:
+        return out
+    direct = use_direct_dft(nfft, rows)
+    for c in range(0, frames.shape[0], CHUNK_COLUMNS):
+        chunk = frames[c:(c + CHUNK_COLUMNS)]
+        out[:, c:(c + chunk.shape[0])] = transform_frames(chunk, nfft, window_key, first, last, detrend, direct).T
+    return out
+
+
+def frame_chunks(frames, size):
+    "Yields (first column, frames) of the frames of several STFTs, size frames at a time"
+    pending = []
+    count = 0
+    start = 0
+    for f in frames:
+        while len(f) > 0:
+            take = f[:(size - count)]
+            pending.append(take)
+            count = count + len(take)
+            f = f[len(take):]
+            if count == size:
+                yield start, numpy.concatenate(pending)
+                start = start + count
+                pending = []
+                count = 0
+    if count > 0:
+        yield start, numpy.concatenate(pending)
+
+
+def psd_band(data, sample_rate, nfft, noverlap, first, last):
+    "Rows first:last of mlab.specgram(data, NFFT=nfft, Fs=sample_rate, noverlap=noverlap)"
+    spec = stft_band(data, nfft, noverlap, 'hanning', first, last)
+    Pxx = (spec.conj() * spec).real
+    # one-sided scaling, every row but DC and Nyquist is doubled
+    inner_first = max(first, 1) - first
+    inner_last = min(last, nfft//2) - first
+    if inner_last > inner_first:
+        Pxx[inner_first:inner_last] *= 2.
+    window = window_of(nfft, 'hanning')
+    Pxx /= sample_rate
+    Pxx /= (numpy.abs(window)**2).sum()
+    return Pxx
+
+
+def psd_band_blocks(blocks, sample_rate, nfft, noverlap, first, last):
+    """Streaming psd_band: yields the spectrogram of consecutive audio blocks in column chunks.
+    The samples of a partial frame are carried to the next block, so the concatenated
+    chunks equal psd_band of the whole signal."""
+    step = nfft - noverlap
+    carry = numpy.zeros(0)
+    for block in blocks:
+        carry = numpy.concatenate([carry, block])
+        if len(carry) < nfft:
+            continue
+        columns = (len(carry) - nfft) // step + 1
+        yield psd_band(carry, sample_rate, nfft, noverlap, first, last)
+        carry = carry[(columns * step):]
+
+
+def magnitude_band(data, nfft, noverlap, first, last):
+    """Rows first:last of scipy.signal.spectrogram(data, nperseg=nfft, noverlap=noverlap,
+    window='hann', scaling='spectrum', mode='magnitude')"""
+    spec = stft_band(data, nfft, noverlap, 'hann', first, last, detrend=True)
+    return numpy.abs(spec) / window_of(nfft, 'hann').sum()
+
+
+def magnitude_band_batch(segments, nfft, noverlap, bands):
+    """magnitude_band of several segments, each with its (first, last) band, in one batched
+    transform: the frames of all the segments are transformed together over the rows of
+    all the bands, a chunk of CHUNK_COLUMNS frames at a time"""
+    frames = [stft_frames(data, nfft, noverlap) for data in segments]
+    first = min(b[0] for b in bands)
+    last = max(b[1] for b in bands)
+    out = numpy.empty((last - first, sum(len(f) for f in frames)))
+    if last > first:
+        direct = use_direct_dft(nfft, last - first)
+        scale = window_of(nfft, 'hann').sum()
+        for (c, chunk) in frame_chunks(frames, CHUNK_COLUMNS):
+            spec = transform_frames(chunk, nfft, 'hann', first, last, True, direct)
+            out[:, c:(c + chunk.shape[0])] = numpy.abs(spec).T / scale
+    results = []
+    c = 0
+    for (f, (band_first, band_last)) in zip(frames, bands):
+        results.append(out[(band_first - first):(band_last - first), c:(c + len(f))])
+        c = c + len(f)
+    return results
+
+
+def to_db(P, offset=0.0):
+    return 10. * numpy.log10(P.clip(min=0.0000000001)) + offset
@@ -0,0 +1,67 @@
+import io
+import math
+import subprocess
+import soundfile as sf
+
+# Formats libsndfile can seek in without decoding from the start
+seekable_extensions = {'wav', 'flac'}
+
+# External decoders used when libsndfile cannot read the codec.
+# Each command reads the encoded audio from stdin and writes a WAV to stdout.
+fallback_commands = {
+    'opus': ['opusdec', '--quiet', '--force-wav', '-', '-'],
+}
+
+
+def fallback_command(extension):
+    if extension in fallback_commands:
+        return fallback_commands[extension]
+    return ['sox', '-t', extension, '-', '-t', 'wav', '-']
+
+
+def read_source(source):
+    "Returns the encoded bytes of a path or a file-like object"
+    if hasattr(source, 'read'):
+        source.seek(0)
+        return source.read()
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+def decode_with_subprocess(source, extension):
+    "Decodes audio by piping it through an external decoder, nothing is written to disk"
+    proc = subprocess.run(fallback_command(extension), input=read_source(source), capture_output=True)
+    if proc.returncode != 0:
+        raise RuntimeError('{} decoder failed: {}'.format(extension, proc.stderr.decode(errors='ignore')))
+    return sf.read(io.BytesIO(proc.stdout))
+
+
+def decode(source, extension):
+    """Decodes a path or file-like object into a numpy buffer and its sample rate.
+    WAV, FLAC and Ogg (Vorbis/Opus) are read in-process by libsndfile, other codecs
+    fall back to an external decoder."""
+    try:
+        return sf.read(source)
+    except RuntimeError:
+        pass
+    return decode_with_subprocess(source, extension)
+
+
+def decode_window(source, iniSecs, endSecs):
+    """Decodes only the frames between iniSecs and endSecs of a seekable source.
+    Returns the window, the sample rate, the total frames in the source and the
+    frame offset of the window."""
+    return decode_windows(source, [(iniSecs, endSecs)])[0]
+
+
+def decode_windows(source, spans):
+    """decode_window of several (iniSecs, endSecs) spans of a seekable source, which is
+    opened once"""
+    windows = []
+    with sf.SoundFile(source) as f:
+        for (iniSecs, endSecs) in spans:
+            start = min(int(math.floor(float(iniSecs) * float(f.samplerate))), f.frames)
+            stop = min(int(math.floor(float(endSecs) * float(f.samplerate))), f.frames)
+            f.seek(start)
+            windows.append((f.read(stop - start), f.samplerate, f.frames, start))
+    return windows
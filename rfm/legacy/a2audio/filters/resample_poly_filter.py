@@ -1,8 +1,24 @@
+import os
 import numpy as np
+from functools import lru_cache
+from math import gcd
 from scipy.signal import firwin
 from scipy.signal import resample_poly
 
-from fractions import gcd
+config = {
+    'filter_dir': os.getenv('RESAMPLE_FILTER_DIR'),
+}
+
+# (current_sample_rate, new_sample_rate) pairs precomputed by `precompute_filters`
+COMMON_RATE_PAIRS = [
+    (48000, 44100),
+    (22050, 44100),
+    (96000, 44100),
+    (32000, 44100),
+    (16000, 44100),
+    (24000, 44100),
+    (88200, 44100),
+]
 
 # Creates an FIR filter for audio resampling
 def resample_poly_filter_window(up, down, beta=5.0, L=16001):
@@ -39,15 +55,101 @@ def resample_poly_filter_window(up, down, beta=5.0, L=16001):
     return filt2
 
 
-def resample_poly_filter(data, current_sample_rate, new_sample_rate):
-    "Resamples a 1d array from a current_sample_rate to a new_sample_rate using resample_poly_filter"
-    
+def filter_path(up, down, beta, L):
+    return os.path.join(config['filter_dir'], 'resample_{}_{}_{}_{}.npy'.format(up, down, beta, L))
+
+
+@lru_cache(maxsize=None)
+def cached_filter_window(up, down, beta=5.0, L=16001):
+    "Filter plan for a reduced (up, down) pair, designed once per process and optionally persisted to RESAMPLE_FILTER_DIR"
+    path = filter_path(up, down, beta, L) if config['filter_dir'] else None
+    if path is not None and os.path.isfile(path):
+        try:
+            window = np.load(path)
+            window.setflags(write=False)
+            return window
+        except (OSError, ValueError):
+            pass
+    window = resample_poly_filter_window(up, down, beta, L)
+    window.setflags(write=False)
+    if path is not None:
+        try:
+            os.makedirs(config['filter_dir'], exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, window)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+    return window
+
+
+def get_filter_window(up, down, beta=5.0, L=16001):
+    g_ = gcd(up, down)
+    return cached_filter_window(up // g_, down // g_, beta, L)
+
+
+def filter_rates(current_sample_rate, new_sample_rate):
     if new_sample_rate in (current_sample_rate*2, current_sample_rate/2):
         new_sample_rate+=1
+    return int(current_sample_rate), int(new_sample_rate)
+
+
+def resample_poly_filter(data, current_sample_rate, new_sample_rate):
+    "Resamples a 1d array from a current_sample_rate to a new_sample_rate using resample_poly_filter"
+
+    current_sample_rate, new_sample_rate = filter_rates(current_sample_rate, new_sample_rate)
 
 		# Create a filter for resampling
-    window = resample_poly_filter_window(new_sample_rate, current_sample_rate)
+    window = get_filter_window(new_sample_rate, current_sample_rate)
     # Resampling with polyphase filtering
     data = resample_poly(data, new_sample_rate, current_sample_rate, window=window)
 
     return data
+
+
+def resample_poly_filter_blocks(blocks, current_sample_rate, new_sample_rate):
+    """Streaming resample_poly_filter: yields the resampled signal of consecutive 1d blocks.
+    Each step resamples a segment aligned to the polyphase period with enough context on
+    both sides for the filter, so the concatenated output equals resampling the whole signal."""
+    current_sample_rate, new_sample_rate = filter_rates(current_sample_rate, new_sample_rate)
+    window = get_filter_window(new_sample_rate, current_sample_rate)
+    g_ = gcd(new_sample_rate, current_sample_rate)
+    up = new_sample_rate // g_
+    down = current_sample_rate // g_
+    # input samples of context around a segment (a multiple of down, so outputs stay aligned)
+    context = down * int(np.ceil((len(window) // up + 2) / down))
+    buffer = np.zeros(0)
+    start = 0
+    done = 0
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        limit = ((start + len(buffer) - context) // down) * down
+        if limit <= done:
+            continue
+        segment_start = max(0, done - context)
+        resampled = resample_poly(buffer[(segment_start - start):(limit + context - start)],
+                                  new_sample_rate, current_sample_rate, window=window)
+        skip = (done - segment_start) * up // down
+        yield resampled[skip:(skip + (limit - done) * up // down)]
+        done = limit
+        drop = max(0, done - context) - start
+        buffer = buffer[drop:]
+        start = start + drop
+    total = start + len(buffer)
+    if total > done:
+        segment_start = max(0, done - context)
+        resampled = resample_poly(buffer[(segment_start - start):], new_sample_rate, current_sample_rate, window=window)
+        skip = (done - segment_start) * up // down
+        yield resampled[skip:]
+
+
+def precompute_filters(rate_pairs=COMMON_RATE_PAIRS):
+    "Designs (and persists when RESAMPLE_FILTER_DIR is set) the filters of the given rate pairs"
+    for (current_sample_rate, new_sample_rate) in rate_pairs:
+        current_sample_rate, new_sample_rate = filter_rates(current_sample_rate, new_sample_rate)
+        get_filter_window(new_sample_rate, current_sample_rate)
+
+
+if __name__ == "__main__":
+    precompute_filters()
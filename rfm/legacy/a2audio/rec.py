@@ -1,20 +1,21 @@
+import contextlib
+import io
 import os
+import shutil
 import time
 import sys
-import traceback
-import urllib.request, urllib.error, urllib.parse
-import http.client
-import subprocess
-import boto3
 import numpy as np
 import warnings
 warnings.filterwarnings( "ignore", module = "matplotlib\..*" )
-import soundfile as sf
+
+from .decoder import decode
+from .reccache import get_cache, config as cache_config
+from ..storage_client import get_client
 
 config = {
-    's3_access_key_id': os.getenv('AWS_ACCESS_KEY_ID'),
-    's3_secret_access_key': os.getenv('AWS_SECRET_ACCESS_KEY'),
-    's3_endpoint': os.getenv('S3_ENDPOINT')
+    'in_memory': os.getenv('REC_IN_MEMORY', '1') == '1',
+    # recordings at least this big are analyzed in streaming mode (0 disables it)
+    'stream_min_bytes': int(os.getenv('STREAM_MIN_BYTES', str(512 * 1024 ** 2)))
 }
 
 encodings = {
@@ -57,7 +58,10 @@ class Rec:
                  logs=True,
                  removeFile=True,
                  test=False,
-                 legacy=True):
+                 legacy=True,
+                 inMemory=config['in_memory'],
+                 prefetched=None,
+                 streamMinBytes=0):
 
         if type(uri) is not str and type(uri) is not str:
             raise ValueError("uri must be a string")
@@ -73,6 +77,12 @@ class Rec:
             raise ValueError("removeFile must be a boolean")
         if type(test) is not bool:
             raise ValueError("test must be a boolean")
+        if type(inMemory) is not bool:
+            raise ValueError("inMemory must be a boolean")
+        if prefetched is not None and type(prefetched) is not dict:
+            raise ValueError("prefetched must be a dict")
+        if type(streamMinBytes) is not int:
+            raise ValueError("streamMinBytes must be an int")
         start_time = time.time()
         self.legacy = legacy
         self.logs = logs
@@ -80,6 +90,15 @@ class Rec:
         self.bucket = bucketName
         self.uri = uri
         self.removeFile = removeFile
+        self.inMemory = inMemory
+        self.buffer = None
+        self.prefetched = prefetched
+        # recordings at least this big are left to a streaming reader, see requiresStreaming
+        self.streamMinBytes = streamMinBytes
+        self.cache = get_cache()
+        self.etag = None
+        self.size = None
+        self.cacheHit = False
         self.original = []
         tempfilename = uri.split('/')
         self.filename = tempfilename[len(tempfilename) - 1]
@@ -102,16 +121,22 @@ class Rec:
             self.status = 'KeyNotFound'
             return None
 
+        if not self.cacheHit and self.requiresStreaming():
+            self.status = 'RequiresStreaming'
+            return None
+
         if self.logs:
             print("getAudioFromUri:" + str(time.time() - start_time))
 
         start_time = time.time()
-        if not self.readAudioFromFile():
-            self.status = 'CorruptedFile'
-            return None
-        if self.logs:
-            print("readAudioFromFile:" +
-                            str(time.time() - start_time))
+        if not self.cacheHit:
+            if not self.readAudioFromFile():
+                self.status = 'CorruptedFile'
+                return None
+            if self.logs:
+                print("readAudioFromFile:" +
+                                str(time.time() - start_time))
+            self.writeAudioToCache()
 
         if not self.removeFiles():
             if self.logs:
@@ -131,18 +156,85 @@ class Rec:
         self.status = 'HasAudioData'
 
     def getAudioFromUri(self):
-        s3 = boto3.resource('s3', 
-                            aws_access_key_id=config['s3_access_key_id'], 
-                            aws_secret_access_key=config['s3_secret_access_key'],
-                            endpoint_url=config['s3_endpoint'])
-        b = s3.Bucket(self.bucket)
+        if self.prefetched is not None and self.getAudioFromPrefetched():
+            return True
+        s3 = get_client()
         try:
-            b.download_file(self.uri, self.localfilename)
+            extraArgs = {}
+            if self.cache is not None and self.etag is None and cache_config['cache_head']:
+                head = s3.head_object(Bucket=self.bucket, Key=self.uri)
+                self.etag = head['ETag']
+                self.size = head['ContentLength']
+            if self.cache is not None and self.etag is not None:
+                if self.readAudioFromCache():
+                    return True
+                # make sure the downloaded body is the one the cache key refers to
+                extraArgs = {'IfMatch': self.etag}
+            if self.requiresStreaming():
+                return True
+            response = s3.get_object(Bucket=self.bucket, Key=self.uri, **extraArgs)
+            self.etag = response['ETag']
+            self.size = response['ContentLength']
+            with contextlib.closing(response['Body']) as body:
+                # the etag and size come with the response, the body is only read on a cache
+                # miss and when it is needed whole
+                if self.cache is not None and len(extraArgs) == 0 and self.readAudioFromCache():
+                    return True
+                if self.requiresStreaming():
+                    return True
+                if self.inMemory:
+                    # read the object body into memory, nothing is written to disk
+                    self.buffer = io.BytesIO(body.read())
+                else:
+                    with open(self.localfilename, 'wb') as f:
+                        shutil.copyfileobj(body, f)
         except:
             print(("missing file. {} {}".format(self.bucket, self.uri)))
             return False
         return True
 
+    def getAudioFromPrefetched(self):
+        self.etag = self.prefetched['etag']
+        self.size = self.prefetched['size']
+        path = self.prefetched['path']
+        # the body itself when it was kept in memory, see prefetch.Spool
+        body = self.prefetched.get('body')
+        self.prefetched = None
+        if path is None and body is None:
+            # cached or left to streaming when prefetched, getAudioFromUri goes on from the etag and size
+            return False
+        try:
+            if self.cache is not None and self.readAudioFromCache():
+                return True
+            if body is not None:
+                data = body.take()
+                if data is None:
+                    return False
+                self.buffer = io.BytesIO(data)
+                return True
+            with open(path, 'rb') as f:
+                self.buffer = io.BytesIO(f.read())
+            return True
+        except OSError:
+            return False
+        finally:
+            # taking the body or deleting its file frees its room in the spool of the prefetcher
+            if body is not None:
+                body.take()
+            if path is not None:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def requiresStreaming(self):
+        "True when the recording is at least streamMinBytes, it is then neither downloaded nor decoded"
+        return self.streamMinBytes > 0 and self.size is not None and self.size >= self.streamMinBytes
+
+    def objectInfo(self):
+        "What the requests told about the recording, as a prefetched dict without a body"
+        return {'etag': self.etag, 'size': self.size, 'path': None}
+
     def parseEncoding(self, enc_key):
         enc = 16
         if enc_key in encodings:
@@ -150,36 +242,14 @@ class Rec:
         return enc
 
     def readAudioFromFile(self):
-        file_extension = self.filename.split('.')[-1]
-        if file_extension == 'opus':
-            process = subprocess.Popen(['opusdec', self.localfilename, self.localfilename+'.wav'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out, err = process.communicate()
-            os.remove(self.localfilename)
-            self.localfilename = self.localfilename+'.wav'
-            if self.logs:
-                print('converted opus file: '+str(self.filename))
-        elif file_extension == 'flac':
-            command = ['/usr/bin/sox', self.localfilename, self.localfilename+'.wav']
-            proc = subprocess.run(command, capture_output=True, text=True)
-            # print('sox stdout:', proc.stdout)
-            # print('sox stderr:', proc.stderr)
-            os.remove(self.localfilename)
-            self.localfilename = self.localfilename+'.wav'
-            if self.logs:
-                print('converted flac file: '+str(self.filename))
-
+        file_extension = self.filename.split('.')[-1].lower()
         try:
-            s, fs = sf.read(self.localfilename)
+            s, fs = decode(self.buffer if self.buffer is not None else self.localfilename, file_extension)
             if self.logs:
                 print(
                     "sampling rate = {} Hz, length = {} samples"
                     .format(fs, len(s)))
-            self.bps = 16
-            self.channs = 1
-            self.samples = len(s)
-            self.sample_rate = fs
-            self.original = s
-            self.status = 'AudioInBuffer'
+            self.setAudioData(s, fs)
             return True
         except Exception as e:
             if self.logs:
@@ -187,8 +257,32 @@ class Rec:
                 print("error:", e)
             return False
 
+    def setAudioData(self, s, fs):
+        self.bps = 16
+        self.channs = 1
+        self.samples = len(s)
+        self.sample_rate = fs
+        self.original = s
+        self.status = 'AudioInBuffer'
+
+    def readAudioFromCache(self):
+        cached = self.cache.get(self.bucket, self.uri, self.etag)
+        if cached is None:
+            return False
+        if self.logs:
+            print("cache hit: " + self.uri)
+        self.setAudioData(*cached)
+        self.cacheHit = True
+        return True
+
+    def writeAudioToCache(self):
+        if self.cache is None or self.etag is None:
+            return False
+        return self.cache.put(self.bucket, self.uri, self.etag, self.original, self.sample_rate)
+
     def removeFiles(self):
         start_time = time.time()
+        self.buffer = None
         if self.removeFile:
             if os.path.isfile(self.localfilename):
                 os.remove(self.localfilename)
@@ -2,25 +2,85 @@ import math
 import numpy
 import os
 import random
+import shutil
 import time
 import warnings
+import tempfile
 import cv2
+import soundfile as sf
 from pylab import *
 from skimage.metrics import structural_similarity as ssim
 from scipy.stats import *
 from scipy.signal import *
+# imported after pylab, which shadows the copy module with numpy.copy
+from copy import copy as shallowcopy
 from ..a2pyutils.logger import Logger
-from .rec import Rec
+from .rec import Rec, config as rec_config
 from .thresholder import Thresholder
-from .filters.resample_poly_filter import resample_poly_filter
+from .filters.resample_poly_filter import resample_poly_filter, resample_poly_filter_blocks
+from .slidingssim import sliding_ssim
+from .bandspec import band_rows, psd_band, psd_band_blocks, psd_freqs, to_db
 from .constants import FREQUENCIES_44100
+from .template import CompiledTemplate, template_rows
+from ..storage_client import S3RangeFile
+
+# Streaming mode (recordings of at least STREAM_MIN_BYTES): frames decoded per block,
+# bytes fetched per ranged GET and spectrogram columns matched per template search
+STREAM_BLOCK_FRAMES = 2**20
+STREAM_READ_BYTES = 8 * 1024 * 1024
+STREAM_MATCH_COLUMNS = 8192
+# Slack on the duration stored for a recording before preflight_status rules it out as short
+PREFLIGHT_DURATION_MARGIN = 0.25
+
+
+def analysis_rate(sample_rate, modelSampleRate):
+    "Sample rate of a recording once Recanalizer resampled it for a model"
+    if sample_rate != modelSampleRate and modelSampleRate >= 44100:
+        return modelSampleRate
+    return sample_rate
+
+
+def spectrogram_nfft(sample_rate):
+    "Half the window (and the hop) of the spectrogram of a recording at sample_rate"
+    if sample_rate > 44100:
+        return 512
+    maxHertzInRec = float(sample_rate)/2.0
+    i = 0
+    while i<len(FREQUENCIES_44100) and FREQUENCIES_44100[i] <= maxHertzInRec:
+        i = i + 1
+    return i
+
+
+def preflight_status(sample_rate, duration, high, columns, modelSampleRate):
+    """The status Recanalizer ends with for a recording of sample_rate and duration (seconds,
+    as stored for the recording) matched against a template of columns up to high Hz, when
+    it is known before downloading it: 'CannotProcess', 'AudioIsShort' or None"""
+    if not sample_rate:
+        return None
+    sample_rate = analysis_rate(sample_rate, modelSampleRate)
+    if float(high) >= float(sample_rate)/2.0:
+        return 'CannotProcess'
+    if duration is None:
+        return None
+    nfft = spectrogram_nfft(sample_rate)
+    samples = int(math.ceil((float(duration) + PREFLIGHT_DURATION_MARGIN) * sample_rate))
+    # the columns of stft_columns for a signal of that many samples
+    if (max(samples, nfft*2) - nfft*2) // nfft + 1 < 2*columns:
+        return 'AudioIsShort'
+    return None
+
 
 class Recanalizer:
-    def __init__(self, uri, speciesSurface, low, high, tempFolder, bucketName, logs=None,test=False,ssim=True,searchMatch=False,db=None,rec_id=None,job_id=None,modelSampleRate=44100,legacy=True):
+    def __init__(self, uri, speciesSurface, low, high, tempFolder, bucketName, logs=None,test=False,ssim=True,searchMatch=False,db=None,rec_id=None,job_id=None,modelSampleRate=44100,legacy=True,prefetched=None,shared=None):
         if type(uri) is not str and type(uri) is not unicode:
             raise ValueError("uri must be a string")
-        if not isinstance(speciesSurface, (numpy.ndarray, numpy.generic, numpy.memmap)):
-            raise ValueError("speciesSurface must be a numpy.ndarray. Input was a "+str(type(speciesSurface)))
+        if isinstance(speciesSurface, CompiledTemplate):
+            template = speciesSurface
+            speciesSurface = template.surface
+        elif isinstance(speciesSurface, (numpy.ndarray, numpy.generic, numpy.memmap)):
+            template = CompiledTemplate(speciesSurface)
+        else:
+            raise ValueError("speciesSurface must be a numpy.ndarray or a CompiledTemplate. Input was a "+str(type(speciesSurface)))
         if type(low) is not int and type(low) is not float:
             raise ValueError("low must be a number")
         if type(high) is not int and type(high) is not float:
@@ -37,6 +97,8 @@ class Recanalizer:
             raise ValueError("bucketName must be a string")
         if logs is not None and not isinstance(logs, Logger):
             raise ValueError("logs must be a a2pyutils.Logger object")
+        if shared is not None and not isinstance(shared, SharedRec):
+            raise ValueError("shared must be a SharedRec object")
         self.ssim = ssim
         self.step = 32
         # start_time = time.time()
@@ -44,6 +106,7 @@ class Recanalizer:
         self.high = float(high)
         self.columns = speciesSurface.shape[1]
         self.speciesSurface = speciesSurface
+        self.template = template
         self.modelSampleRate = modelSampleRate
         self.logs = logs
         self.uri = uri
@@ -56,6 +119,10 @@ class Recanalizer:
         self.rec_id = rec_id
         self.job_id = job_id
         self.legacy = legacy
+        self.prefetched = prefetched
+        self.shared = shared
+        # False once libsndfile failed to open the recording for streaming
+        self.streamable = shared.streamable if shared is not None else True
         # if self.logs:
         #    self.logs.write("processing: "+self.uri)
         # if self.logs :
@@ -65,13 +132,22 @@ class Recanalizer:
             self.process()
 
     def process(self):
+        if self.streamingRequired() and self.processStream():
+            return
         start_time = time.time()
         self.instanceRec()
+        if self.rec.status == 'RequiresStreaming':
+            # the size was only known once Rec asked for the recording
+            if self.processStream():
+                return
+            self.instanceRec()
         if self.logs:
             self.logs.write("retrieving recording from bucket --- seconds ---" + str(time.time() - start_time))
+            if self.rec.cache is not None:
+                self.logs.write("recording cache {} --- {}".format('hit' if self.rec.cacheHit else 'miss', self.rec.cache.stats()))
         if self.rec.status == 'HasAudioData':
             # If the recording's sample rate is not modelSampleRate, resample the audio data
-            if self.rec.sample_rate != self.modelSampleRate and self.modelSampleRate >= 44100:
+            if analysis_rate(self.rec.sample_rate, self.modelSampleRate) != self.rec.sample_rate:
                 self.rec_resample(self.modelSampleRate)
             maxFreqInRec = float(self.rec.sample_rate)/2.0
             if self.high >= maxFreqInRec:
@@ -105,7 +181,110 @@ class Recanalizer:
         return self.rec
 
     def instanceRec(self):
-        self.rec = Rec(str(self.uri),self.tempFolder,self.bucketName,None,legacy=self.legacy)
+        if self.shared is not None:
+            self.rec = self.shared.getRec(self.modelSampleRate, self.streamable)
+            return
+        if self.rec is not None:
+            # decoding whole a recording that couldn't be streamed, without asking for it again
+            self.prefetched = self.rec.objectInfo()
+        streamMinBytes = rec_config['stream_min_bytes'] if self.streamable else 0
+        self.rec = Rec(str(self.uri),self.tempFolder,self.bucketName,None,legacy=self.legacy,prefetched=self.prefetched,streamMinBytes=streamMinBytes)
+        self.prefetched = None
+
+    def knownObject(self):
+        "(size, etag) of the recording when a request already told them, (None, None) otherwise"
+        if self.shared is not None:
+            return self.shared.size, self.shared.etag
+        if self.rec is not None:
+            return self.rec.size, self.rec.etag
+        if self.prefetched is not None:
+            return self.prefetched['size'], self.prefetched['etag']
+        return None, None
+
+    def streamingRequired(self):
+        """True when the recording is known to be too big to be decoded in memory at once.
+        A size that is not known yet is learned by Rec from the request it makes anyway,
+        it then stops with 'RequiresStreaming' before reading the body"""
+        if rec_config['stream_min_bytes'] <= 0 or not self.streamable:
+            return False
+        size = self.knownObject()[0]
+        return size is not None and size >= rec_config['stream_min_bytes']
+
+    def audioBlocks(self, audio):
+        "Mono blocks of the recording, resampled to modelSampleRate like rec_resample does"
+        blocks = (b.mean(axis=1) if b.ndim > 1 else b
+                  for b in audio.blocks(blocksize=STREAM_BLOCK_FRAMES))
+        if audio.samplerate != self.modelSampleRate and self.modelSampleRate >= 44100:
+            return resample_poly_filter_blocks(blocks, audio.samplerate, self.modelSampleRate), self.modelSampleRate
+        return blocks, audio.samplerate
+
+    def streamSource(self, size, etag):
+        "What processStream decodes: ranged GETs of the recording, or the copy of a SharedRec"
+        if self.shared is not None:
+            return self.shared.streamSource(size, etag)
+        return S3RangeFile(self.bucketName, self.uri, block_size=STREAM_READ_BYTES, size=size, etag=etag)
+
+    def processStream(self):
+        """Analyzes a long recording without holding its audio in memory: audio is decoded
+        block by block from ranged GETs (or from the copy of a SharedRec), the band spectrogram
+        is spilled to a temporary file and the template is matched over a memory map of it.
+        Returns False, with nothing analyzed, when libsndfile cannot open the recording:
+        decoder.decode falls back to an external decoder for such formats, so they are decoded
+        whole instead"""
+        start_time = time.time()
+        size, etag = self.knownObject()
+        try:
+            audio = sf.SoundFile(self.streamSource(size, etag))
+        except RuntimeError as e:
+            if self.logs:
+                self.logs.write("cannot stream {}, decoding it whole: {}".format(self.uri, e))
+            self.streamable = False
+            if self.shared is not None:
+                self.shared.streamable = False
+            return False
+        except Exception as e:
+            if self.logs:
+                self.logs.write("streaming {} failed: {}".format(self.uri, e))
+            self.status = 'CorruptedFile'
+            return True
+        fd, specPath = tempfile.mkstemp(dir=self.tempFolder, suffix='.spec')
+        try:
+            with audio:
+                blocks, sample_rate = self.audioBlocks(audio)
+                if self.high >= float(sample_rate)/2.0:
+                    self.status = 'CannotProcess'
+                    return True
+                nfft, first, last = self.spectrogramBand(sample_rate)
+                columns = 0
+                specMin = numpy.inf
+                specMax = -numpy.inf
+                with os.fdopen(fd, 'wb') as f:
+                    fd = None
+                    for Pxx in psd_band_blocks(blocks, sample_rate, nfft*2, nfft, first, last):
+                        chunk = np.flipud(to_db(Pxx))
+                        specMin = min(specMin, chunk.min())
+                        specMax = max(specMax, chunk.max())
+                        columns = columns + chunk.shape[1]
+                        # column-major, so the file can be mapped as a (rows, columns) array
+                        f.write(numpy.asfortranarray(chunk).tobytes(order='F'))
+            if self.logs:
+                self.logs.write("streamed spectrogram of {} columns --- seconds ---{}".format(columns, time.time() - start_time))
+            if columns < 2*self.speciesSurface.shape[1]:
+                self.status = 'AudioIsShort'
+                return True
+            self.spec = numpy.memmap(specPath, dtype=numpy.float64, mode='r', shape=(last-first, columns), order='F')
+            self.featureVector_search_stream(specMin, specMax)
+            self.status = 'Processed'
+        except Exception as e:
+            if self.logs:
+                self.logs.write("streaming {} failed: {}".format(self.uri, e))
+            self.status = 'CorruptedFile'
+        finally:
+            if fd is not None:
+                os.close(fd)
+            # an open memory map keeps the data readable after the unlink
+            os.remove(specPath)
+        return True
 
     def getVector(self ):
         return self.distances
@@ -138,6 +317,11 @@ class Recanalizer:
                     ,fs[0],fs[1],fs[2],fs[3],fs[4],fs[5],fs[6],fs[7],fs[8],fs[9],fs[10]]
         return ffs
 
+    def templateImage(self):
+        "Species surface rows of the band as an 8 bit image, as matched against the spectrogram"
+        self.matrixSurfacComp, pat = self.template.band(self.spechigh, self.speclow)
+        return pat
+
     def featureVector_search(self):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
@@ -146,23 +330,34 @@ class Recanalizer:
             # if self.logs:
             #    self.logs.write(self.uri)
 
-            self.matrixSurfacComp = numpy.copy(self.speciesSurface[self.spechigh:self.speclow,:])
-            removeUnwanted = self.matrixSurfacComp == -10000
-            if len(removeUnwanted) > 0  :
-                self.matrixSurfacComp[self.matrixSurfacComp[:,:]==-10000] = numpy.min(self.matrixSurfacComp[self.matrixSurfacComp != -10000])
+            pat = self.templateImage()
             spec = self.spec
             currColumns = self.spec.shape[1]
             spec = ((spec-numpy.min(numpy.min(spec)))/(numpy.max(numpy.max(spec))-numpy.min(numpy.min(spec))))*255
             spec = spec.astype('uint8')
-            pat = self.matrixSurfacComp
-            pat = ((pat-numpy.min(numpy.min(pat)))/(numpy.max(numpy.max(pat))-numpy.min(numpy.min(pat))))*255
-            pat = pat.astype('uint8')
             th, tw = pat.shape[:2]
 
             result = cv2.matchTemplate(spec, pat, cv2.TM_CCOEFF_NORMED)
 
             self.distances = numpy.mean(result,axis=0)
 
+    def featureVector_search_stream(self, specMin, specMax):
+        """featureVector_search over a spectrogram too big to normalize in one piece: it is
+        quantized with its global min/max and matched in overlapping runs of columns"""
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            pat = self.templateImage()
+            th, tw = pat.shape[:2]
+            currColumns = self.spec.shape[1]
+            distances = []
+            for c in range(0, currColumns - tw + 1, STREAM_MATCH_COLUMNS):
+                spec = numpy.asarray(self.spec[:, c:(c + STREAM_MATCH_COLUMNS + tw - 1)])
+                spec = ((spec-specMin)/(specMax-specMin))*255
+                spec = spec.astype('uint8')
+                result = cv2.matchTemplate(spec, pat, cv2.TM_CCOEFF_NORMED)
+                distances.append(numpy.mean(result,axis=0))
+            self.distances = numpy.concatenate(distances)
+
     def featureVector(self):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
@@ -176,8 +371,7 @@ class Recanalizer:
             step = self.step
             if self.logs:
                self.logs.write("featureVector start")
-            self.matrixSurfacComp = numpy.copy(self.speciesSurface[self.spechigh:self.speclow,:])
-            self.matrixSurfacComp[self.matrixSurfacComp[:,:]==-10000] = numpy.min(self.matrixSurfacComp[self.matrixSurfacComp != -10000])
+            self.templateImage()
             winSize = min(self.matrixSurfacComp.shape)
             winSize = min(winSize,7)
             if winSize %2 == 0:
@@ -191,11 +385,8 @@ class Recanalizer:
                 if self.ssim:
                     if self.logs:
                         self.logs.write("using ssim")
-                    for j in range(0,currColumns - self.columns,step):
-                        val = ssim( numpy.copy(spec[: , j:(j+self.columns)]) , self.matrixSurfacComp , win_size=winSize)
-                        if val < 0:
-                           val = 0
-                        self.distances.append(  val   )
+                    offsets = range(0,currColumns - self.columns,step)
+                    self.distances = list(numpy.clip(sliding_ssim(spec, self.matrixSurfacComp, offsets, win_size=winSize), 0, None))
                 else:
                     if self.logs:
                         self.logs.write("not using ssim")
@@ -272,85 +463,41 @@ class Recanalizer:
     def getSpec(self):
         return self.spec
 
-    def spectrogram(self):
-        maxHertzInRec = float(self.rec.sample_rate)/2.0
-        i = 0
-        nfft = 512
-        if self.rec.sample_rate <= 44100:
-            while i<len(FREQUENCIES_44100) and FREQUENCIES_44100[i] <= maxHertzInRec:
-                i = i + 1
-            nfft = i
-        start_time = time.time()
+    def spectrogramBand(self, sample_rate):
+        """Sets the template rows (spechigh:speclow) for a recording at sample_rate and
+        returns (nfft, first row, last row) of the spectrogram rows to compute"""
+        nfft = spectrogram_nfft(sample_rate)
+        # only the rows of the species band (plus two on each side) are computed
+        freqs = psd_freqs(nfft*2, sample_rate)
+        rows = len(freqs)
+        j, i = band_rows(freqs, self.low, self.high)
+        if i >= rows:
+            i = rows - 1
+        first = numpy.max([0, (j-2)])
+        last = numpy.min([(i+2), rows])
 
-        Pxx, freqs, bins = mlab.specgram(self.rec.original, NFFT=nfft *2, Fs=self.rec.sample_rate , noverlap=nfft )
-        if self.rec.sample_rate < 44100:
-            self.rec.sample_rate = 44100
-        dims =  Pxx.shape
-        # if self.logs:
-        #     self.logs.write("mlab.specgram --- seconds ---" + str(time.time() - start_time))
-
-        i = 0
-        j = 0
-        start_time = time.time()
-        while freqs[i] < self.low:
-            j = j + 1
-            i = i + 1
-
-        #calculate decibeles in the passband
-        Pxx =  10. * np.log10( Pxx.clip(min=0.0000000001))
-        while (i < len(freqs)) and (freqs[i] < self.high):
-            i = i + 1
-
-        if i >= dims[0]:
-            i = dims[0] - 1
-
-        Z= Pxx[numpy.max([0, (j-2)]):numpy.min([(i+2), Pxx.shape[0]]),:]
-
-        self.highIndex = dims[0]-j
-        self.lowIndex = dims[0]-i
+        self.highIndex = rows-j
+        self.lowIndex = rows-i
 
         if self.lowIndex < 0:
             self.lowIndex = 0
 
-        if self.highIndex >= dims[0]:
-            self.highIndex = dims[0] - 1
-        i = 0
-        j = 0
-        if self.rec.sample_rate <= 44100:
-            i = len(FREQUENCIES_44100) - 1
-            j = i
-            while FREQUENCIES_44100[i] > self.high and i>=0:
-                j = j -1
-                i = i -1
-
-            while FREQUENCIES_44100[j] > self.low and j>=0:
-                j = j -1
-            self.speclow = len(FREQUENCIES_44100) - j - 2
-            self.spechigh = len(FREQUENCIES_44100) - i - 2
-            if self.speclow >= len(FREQUENCIES_44100):
-                self.speclow = len(FREQUENCIES_44100)-1
-            if self.spechigh < 0:
-                self.spechigh = 0
+        if self.highIndex >= rows:
+            self.highIndex = rows - 1
+        self.spechigh, self.speclow = template_rows(self.low, self.high, sample_rate)
+        return nfft, first, last
+
+    def spectrogram(self):
+        nfft, first, last = self.spectrogramBand(self.rec.sample_rate)
+        if self.shared is not None:
+            Pxx = self.shared.psdBand(self.rec.original, self.rec.sample_rate, nfft*2, nfft, first, last)
         else:
-            i = len(freqs) - 1
-            j = i
-            while freqs[i] > self.high and i>=0:
-                j = j -1
-                i = i -1
-
-            while freqs[j] > self.low and j>=0:
-                j = j -1
-            self.speclow = len(freqs) - j - 2
-            self.spechigh = len(freqs) - i - 2
-            if self.speclow >= len(freqs):
-                self.speclow = len(freqs)-1
-            if self.spechigh < 0:
-                self.spechigh = 0
-        Z = np.flipud(Z)
-        # if self.logs:
-        #     self.logs.write("spec hi : %s spec low: %s" % (self.spechigh, self.speclow))
-        #     self.logs.write('logs and flip ---' + str(time.time() - start_time))
-        self.spec = Z
+            Pxx = psd_band(self.rec.original, self.rec.sample_rate, nfft*2, nfft, first, last)
+        if self.rec.sample_rate < 44100:
+            self.rec.sample_rate = 44100
+
+        #calculate decibeles in the passband
+        self.spec = np.flipud(to_db(Pxx))
 
     def showVectAndSpec(self):
         ax1 = subplot(211)
@@ -376,3 +523,92 @@ class Recanalizer:
         )
         self.rec.samples = len(self.rec.original)
         self.rec.sample_rate = newSampleRate
+
+
+class SharedRec:
+    """A recording analyzed by several models (Recanalizer(..., shared=SharedRec(...))).
+    It is fetched and decoded once, resampled once per model sample rate and every
+    spectrogram row is computed once per (sample rate, nfft). A recording too big to be
+    decoded whole is streamed by each model: when more than one (analyses) will stream it,
+    it is downloaded once to tempFolder and every model decodes that copy. close() removes it."""
+
+    def __init__(self, uri, tempFolder, bucketName, legacy=True, prefetched=None, analyses=1):
+        self.uri = uri
+        self.tempFolder = tempFolder
+        self.bucketName = bucketName
+        self.legacy = legacy
+        self.prefetched = prefetched
+        # size and etag once a request told them, see Recanalizer.knownObject
+        self.size = prefetched['size'] if prefetched is not None else None
+        self.etag = prefetched['etag'] if prefetched is not None else None
+        self.streamable = True
+        self.rec = None
+        self.resampled = {}
+        self.psdRows = {}
+        self.analyses = analyses
+        self.localCopy = None
+
+    def streamSource(self, size, etag):
+        """What Recanalizer.processStream decodes the recording from: ranged GETs when a
+        single model streams it, otherwise the path of a copy downloaded once by the first"""
+        if self.analyses < 2:
+            return S3RangeFile(self.bucketName, self.uri, block_size=STREAM_READ_BYTES, size=size, etag=etag)
+        if self.localCopy is None:
+            fd, path = tempfile.mkstemp(dir=self.tempFolder, suffix='.stream')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    source = S3RangeFile(self.bucketName, self.uri, block_size=STREAM_READ_BYTES, size=size, etag=etag)
+                    shutil.copyfileobj(source, f, STREAM_READ_BYTES)
+            except Exception:
+                os.remove(path)
+                raise
+            self.localCopy = path
+        return self.localCopy
+
+    def close(self):
+        "Removes the copy of a streamed recording"
+        if self.localCopy is not None:
+            os.remove(self.localCopy)
+            self.localCopy = None
+
+    def getRec(self, modelSampleRate, streamable=True):
+        """A copy of the recording as Recanalizer.process prepares it for a model at modelSampleRate.
+        Its status is 'RequiresStreaming' when it is too big to be decoded whole, unless streamable
+        is False"""
+        if self.rec is None or (self.rec.status == 'RequiresStreaming' and not streamable):
+            if self.rec is not None:
+                self.prefetched = self.rec.objectInfo()
+            streamMinBytes = rec_config['stream_min_bytes'] if streamable else 0
+            self.rec = Rec(str(self.uri),self.tempFolder,self.bucketName,None,legacy=self.legacy,prefetched=self.prefetched,streamMinBytes=streamMinBytes)
+            self.prefetched = None
+            if self.rec.size is not None:
+                self.size = self.rec.size
+                self.etag = self.rec.etag
+        rec = self.rec
+        if rec.status == 'HasAudioData' and rec.sample_rate != modelSampleRate and modelSampleRate >= 44100:
+            if modelSampleRate not in self.resampled:
+                rec = shallowcopy(self.rec)
+                rec.original = resample_poly_filter(rec.original, rec.sample_rate, modelSampleRate)
+                rec.samples = len(rec.original)
+                rec.sample_rate = modelSampleRate
+                self.resampled[modelSampleRate] = rec
+            rec = self.resampled[modelSampleRate]
+        # Recanalizer updates the sample rate of its rec
+        return shallowcopy(rec)
+
+    def psdBand(self, data, sample_rate, nfft, noverlap, first, last):
+        "psd_band of the audio at sample_rate, reusing the rows computed for other models"
+        rows = self.psdRows.setdefault((sample_rate, nfft), {})
+        missing = [r for r in range(first, last) if r not in rows]
+        while len(missing) > 0:
+            # compute contiguous runs of missing rows in one go
+            run = 1
+            while run < len(missing) and missing[run] == missing[0] + run:
+                run = run + 1
+            Pxx = psd_band(data, sample_rate, nfft, noverlap, missing[0], missing[0] + run)
+            for k in range(run):
+                rows[missing[0] + k] = Pxx[k]
+            missing = missing[run:]
+        if last <= first:
+            return psd_band(data, sample_rate, nfft, noverlap, first, last)
+        return numpy.array([rows[r] for r in range(first, last)])
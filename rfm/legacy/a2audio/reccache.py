@@ -0,0 +1,169 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+import numpy as np
+
+config = {
+    'cache_dir': os.getenv('REC_CACHE_DIR'),
+    'cache_max_bytes': int(os.getenv('REC_CACHE_MAX_BYTES', str(10 * 1024 ** 3))),
+    # ask for the etag with a HEAD before downloading, pays off when most recordings are cache hits
+    'cache_head': os.getenv('REC_CACHE_HEAD') == '1',
+}
+
+# after an eviction the cache is shrunk to this fraction of max_bytes, so
+# that the next few writes don't trigger another full scan
+LOW_WATERMARK = 0.9
+# temporary files older than this were left behind by a killed writer
+STALE_TMP_SECS = 3600
+
+
+class RecCache:
+    """Content-addressed local disk cache of decoded recordings, shared by all jobs
+    and worker processes on a node.
+
+    Entries are keyed by (bucket, uri, etag) so a re-uploaded object is never served
+    stale. Writes go to a temporary file that is atomically renamed into place, the
+    file mtime is the last access time and eviction (LRU, bounded to max_bytes) runs
+    under an exclusive flock on the cache folder.
+    """
+
+    def __init__(self, folder, max_bytes):
+        if type(folder) is not str:
+            raise ValueError("folder must be a string")
+        if type(max_bytes) is not int or max_bytes <= 0:
+            raise ValueError("max_bytes must be a positive int")
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.folder, exist_ok=True)
+        self.lock_path = os.path.join(self.folder, '.lock')
+        self.size_path = os.path.join(self.folder, '.size')
+
+    def key(self, bucket, uri, etag):
+        return hashlib.sha256('\0'.join([bucket, uri, etag]).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key + '.npz')
+
+    def contains(self, bucket, uri, etag):
+        return os.path.isfile(self.path(self.key(bucket, uri, etag)))
+
+    def get(self, bucket, uri, etag):
+        "Returns (samples, sample_rate) or None on a miss"
+        path = self.path(self.key(bucket, uri, etag))
+        try:
+            with np.load(path) as entry:
+                samples = entry['samples'].astype(np.float64)
+                sample_rate = int(entry['sample_rate'])
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            # missing, or evicted by another process while we were reading it
+            self.misses += 1
+            return None
+        self.hits += 1
+        return samples, sample_rate
+
+    def put(self, bucket, uri, etag, samples, sample_rate):
+        path = self.path(self.key(bucket, uri, etag))
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        # float32 halves the footprint and is lossless for 16 and 24 bit sources
+        compact = samples.astype(np.float32)
+        if not np.array_equal(compact, samples):
+            compact = samples
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, samples=compact, sample_rate=sample_rate)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        self.add_size(size)
+        return True
+
+    def entries(self):
+        "Lists (mtime, size, path) of every entry, removing stale temporary files"
+        entries = []
+        now = time.time()
+        for sub in os.scandir(self.folder):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith('.npz'):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                elif entry.name.endswith('.tmp') and now - stat.st_mtime > STALE_TMP_SECS:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+        return entries
+
+    def add_size(self, size):
+        "Adds size to the running total and evicts least recently used entries when over max_bytes"
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                total = self.read_size()
+                if total is None:
+                    total = sum(s for (_, s, _) in self.entries())
+                else:
+                    total = total + size
+                if total > self.max_bytes:
+                    total = self.evict()
+                self.write_size(total)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def evict(self):
+        "Removes least recently used entries, must be called with the lock held. Returns the new total size"
+        entries = sorted(self.entries())
+        total = sum(s for (_, s, _) in entries)
+        target = self.max_bytes * LOW_WATERMARK
+        for (_, size, path) in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total = total - size
+            self.evictions += 1
+        return total
+
+    def read_size(self):
+        try:
+            with open(self.size_path) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def write_size(self, total):
+        with open(self.size_path, 'w') as f:
+            f.write(str(int(total)))
+
+    def stats(self):
+        return 'hits={} misses={} evictions={}'.format(self.hits, self.misses, self.evictions)
+
+
+_cache = None
+
+
+def get_cache():
+    "Returns this process' RecCache, or None when REC_CACHE_DIR is not set"
+    global _cache
+    if config['cache_dir'] is None:
+        return None
+    if _cache is None:
+        _cache = RecCache(config['cache_dir'], config['cache_max_bytes'])
+    return _cache
@@ -3,6 +3,7 @@ import numpy
 numpy.seterr(all='ignore')
 import scipy
 import math
+from .alignment import OffsetSearch
 class Roiset:   
 
     def __init__(self, classId,setSRate):
@@ -18,28 +19,29 @@ class Roiset:
         self.sampleRates = []
         self.setSampleRate = setSRate
         
-    def addRoi(self,lowFreq,highFreq,sample_rate,spec,rows,columns):
+    def addRoi(self,lowFreq,highFreq,sample_rate,spec,rows,columns,row=0):
+        """Adds the spectrogram of a roi, spec being the rows row:(row+len(spec)) of a matrix of
+        rows x columns where every other row is 0 (the band, as Roizer keeps it)"""
         if self.setSampleRate == sample_rate:
+            roi = Roi(lowFreq,highFreq,sample_rate,spec,row)
             if len(self.sampleLengths) < 1:
                 self.maxColumns = columns
                 self.varlengthsIndeces = []
                 self.maxIndeces = []
-                self.maxrois = []
                 self.varlengths = set()
-                self.maxrois.append(spec)
                 self.maxIndeces.append(self.roiCount)
                 self.lowestFreq = lowFreq
                 self.highestFreq = highFreq
                 self.highestlowestFreq = lowFreq
                 self.lowesthighestFreq = highFreq
-                self.biggestRoi = spec
+                self.biggestRoi = roi
                 self.highestBand = highFreq - lowFreq
             else:
                 highestBand = highFreq - lowFreq
                 if self.maxColumns < columns:
-                    self.biggestRoi = spec
+                    self.biggestRoi = roi
                 if self.highestBand <= highestBand and self.maxColumns < columns:
-                    self.biggestRoi = spec
+                    self.biggestRoi = roi
                 if self.lowestFreq > lowFreq:
                     self.lowestFreq = lowFreq
                 if self.highestFreq < highFreq:
@@ -55,11 +57,8 @@ class Roiset:
                         self.varlengthsIndeces.append(i)
                     self.maxIndeces = []
                     self.maxIndeces.append(self.roiCount)
-                    self.maxrois = []
-                    self.maxrois.append(spec)
                 elif self.maxColumns == columns:
                     self.maxIndeces.append(self.roiCount)
-                    self.maxrois.append(spec)
                 else:
                     self.varlengthsIndeces.append(self.roiCount)
                     self.varlengths.add(columns)
@@ -67,11 +66,11 @@ class Roiset:
             self.sampleRates.append(sample_rate)    
             self.sampleLengths.append(columns)
             self.rows = rows
-            self.roi.append(Roi(lowFreq,highFreq,sample_rate,spec)) 
+            self.roi.append(roi)
             self.roiCount = self.roiCount + 1
     
     def getData(self):
-        return [self.roi,self.rows,self.roiCount,self.biggestRoi,self.lowestFreq,self.highestFreq,self.maxColumns]
+        return [self.roi,self.rows,self.roiCount,self.biggestRoi.full(self.rows),self.lowestFreq,self.highestFreq,self.maxColumns]
   
     def getSurface(self):
         return self.meanSurface
@@ -80,6 +79,8 @@ class Roiset:
         surface = numpy.zeros(shape=(self.rows,self.maxColumns))
         weights = numpy.zeros(shape=(self.rows,self.maxColumns))
         freqs = [self.setSampleRate/2/(self.rows-1)*i for i in reversed(range(0,surface.shape[0]))]
+        # the only roi expanded to all its rows
+        search = OffsetSearch(self.biggestRoi.full(self.rows))
         for roi in self.roi:
             high_index = 0
             low_index = 0
@@ -88,18 +89,12 @@ class Roiset:
                 low_index  = low_index  + 1
             while freqs[low_index ] >=  roi.lowFreq:
                 low_index  = low_index  + 1
-            distances = []
             currColumns = roi.spec.shape[1]
-            
-            for jj in range(self.maxColumns -currColumns ): 
-                subMatrix =   self.biggestRoi[high_index:low_index, jj:(jj+currColumns)]
-                distances.append(numpy.linalg.norm(subMatrix  - roi.spec[high_index:low_index,:]) )
-            if len(distances) > 0:
-                j = distances.index(min(distances))
-            else:
-                j = 0
+            band = roi.band(high_index, low_index)
+            # offset of the roi in the biggest one, all the offsets are scored at once
+            j = search.best_offset(band, high_index, self.maxColumns - currColumns)
 
-            surface[high_index:low_index, j:(j+currColumns)] = surface[high_index:low_index, j:(j+currColumns)] + roi.spec[high_index:low_index, :]            
+            surface[high_index:low_index, j:(j+currColumns)] = surface[high_index:low_index, j:(j+currColumns)] + band
                 
             weights[high_index:low_index, j:(j+currColumns)] = weights[high_index:low_index, j:(j+currColumns)]  + 1
             
@@ -107,6 +102,7 @@ class Roiset:
         self.meanSurface[numpy.isnan(self.meanSurface)]   = -10000
         
     def alignSamples2(self):
+        self.maxrois = [self.roi[i].full(self.rows) for i in self.maxIndeces]
         self.surface = numpy.sum(self.maxrois,axis=0)
         weights = numpy.zeros(shape=(self.rows,self.maxColumns))
         freqs = [self.setSampleRate/2/(self.rows-1)*i for i in reversed(range(0,self.surface.shape[0]))]
@@ -123,14 +119,15 @@ class Roiset:
         for i in self.varlengthsIndeces:
             distances = []
             currColumns = self.roi[i].spec.shape[1]
+            spec = self.roi[i].full(self.rows)
             for j in range(self.maxColumns -currColumns ): 
                 subMatrix =  self.surface[:, j:(j+currColumns)]
-                distances.append(numpy.linalg.norm(subMatrix  - self.roi[i].spec) )
+                distances.append(numpy.linalg.norm(subMatrix  - spec) )
             j = distances.index(min(distances))
             temp = numpy.zeros(shape=(self.rows,self.maxColumns))
-            temp[:, j:(j+currColumns)] = self.roi[i].spec
+            temp[:, j:(j+currColumns)] = spec
             self.maxrois.append(temp)
-            self.surface[:, j:(j+currColumns)] = self.surface[:, j:(j+currColumns)] + self.roi[i].spec
+            self.surface[:, j:(j+currColumns)] = self.surface[:, j:(j+currColumns)] + spec
             
             high_index = 0
             low_index = 0
@@ -172,7 +169,7 @@ class Roiset:
 
 class Roi:
 
-    def __init__(self,lowFreq,highFreq,sample_rate,spec):
+    def __init__(self,lowFreq,highFreq,sample_rate,spec,row=0):
         if type(lowFreq) is not int and  type(lowFreq) is not float:
             raise ValueError("lowFreq must be a number")
         if type(highFreq) is not int and  type(highFreq) is not float:
@@ -186,10 +183,25 @@ class Roi:
         self.lowFreq = lowFreq
         self.highFreq = highFreq
         self.sample_rate = sample_rate
+        # rows row:(row+len(spec)) of the roi spectrogram, the others are 0
         self.spec = spec
+        self.row = row
     
     def getData(self):
         return [self.lowFreq,self.highFreq,self.sample_rate,self.spec]
+
+    def band(self, first, last):
+        "Rows first:last of the roi spectrogram, as float64"
+        rows = numpy.zeros(shape=(last - first, self.spec.shape[1]))
+        lo = max(first, self.row)
+        hi = min(last, self.row + self.spec.shape[0])
+        if hi > lo:
+            rows[(lo - first):(hi - first), :] = self.spec[(lo - self.row):(hi - self.row), :]
+        return rows
+
+    def full(self, rows):
+        "The roi spectrogram with all its rows"
+        return self.band(0, rows)
     
     def showRoi(self):
         ax1 = subplot(111)
@@ -2,15 +2,65 @@ from pylab import *
 from matplotlib import *
 import numpy
 import math
-from scipy.signal import spectrogram
+import os
 
+from .bandspec import band_rows, magnitude_band, magnitude_band_batch, magnitude_freqs, to_db
 from .constants import FREQUENCIES_44100
+from .decoder import decode_window, decode_windows, seekable_extensions
 from .rec import Rec
+from ..storage_client import S3RangeFile
+
+config = {
+    'windowed_read': os.getenv('ROI_WINDOWED_READ', '1') == '1'
+}
+
+
+class RoiResult:
+    """What training keeps of a Roizer: the band and sample rate of the roi and its
+    spectrogram band (float32, rows specRow:(specRow+len(spec)) of specRows), without the audio"""
+    __slots__ = ('lowF', 'highF', 'sample_rate', 'spec', 'specRow', 'specRows')
+
+    def __init__(self, lowF, highF, sample_rate, spec, specRow, specRows):
+        self.lowF = lowF
+        self.highF = highF
+        self.sample_rate = sample_rate
+        self.spec = numpy.ascontiguousarray(spec, dtype=numpy.float32)
+        self.specRow = specRow
+        self.specRows = specRows
+
+
+def roize(uri, tempFolder, bucketName, rois, legacy=True, windowed=config['windowed_read']):
+    """Roizers of several (iniSecs, endiSecs, lowFreq, highFreq) rois of one recording, which
+    is fetched once: a seekable file is read from a single ranged-GET source, a window per
+    roi, any other file is decoded once for all the rois. Their spectrograms are computed
+    together by magnitude_band_batch"""
+    audios = None
+    if windowed and uri.split('.')[-1].lower() in seekable_extensions:
+        try:
+            audios = decode_windows(S3RangeFile(bucketName, uri), [(iniSecs, endiSecs) for (iniSecs, endiSecs, _, _) in rois])
+        except Exception:
+            audios = None
+        if audios is not None and any(window[2] == 0 for window in audios):
+            audios = None
+    if audios is None:
+        audios = [Rec(uri,tempFolder,bucketName,None,legacy=legacy)] * len(rois)
+    roizers = [Roizer(uri, tempFolder, bucketName, iniSecs, endiSecs, lowFreq, highFreq, legacy, windowed, audio=audio, compute=False)
+               for ((iniSecs, endiSecs, lowFreq, highFreq), audio) in zip(rois, audios)]
+    pending = [roizer for roizer in roizers if 'HasAudioData' in roizer.status]
+    bands = [roizer.spectrogramBand() for roizer in pending]
+    # the rois of a recording share its sample rate, so its nfft
+    for nfft in set(band[1] for band in bands):
+        batch = [(roizer, band) for (roizer, band) in zip(pending, bands) if band[1] == nfft]
+        magnitudes = magnitude_band_batch([band[0] for (_, band) in batch], nfft*2, nfft,
+                                          [(band[2], band[3]) for (_, band) in batch])
+        for ((roizer, _), magnitude) in zip(batch, magnitudes):
+            roizer.setBand(magnitude)
+    return roizers
 
 
 class Roizer:
 
-    def __init__(self, uri, tempFolder, bucketName, iniSecs=5, endiSecs=15, lowFreq = 1000, highFreq = 2000, legacy=True):
+    def __init__(self, uri, tempFolder, bucketName, iniSecs=5, endiSecs=15, lowFreq = 1000, highFreq = 2000, legacy=True, windowed=config['windowed_read'], audio=None, compute=True):
         
         if type(uri) is not str and type(uri) is not unicode:
             raise ValueError("uri must be a string")
@@ -35,44 +85,95 @@ class Roizer:
         if lowFreq>=highFreq :
             raise ValueError("lowFreq must be less than highFreq")
         self.spec = None
-        recording = Rec(uri,tempFolder,bucketName,None,legacy=legacy)
+        # self.spec holds the rows specRow:(specRow+len(spec)) of a specRows rows spectrogram
+        self.specRow = 0
+        self.specRows = 0
+        # frame of the recording where self.original starts
+        self.offset = 0
+        if isinstance(audio, Rec):
+            # decoded by the caller, shared with other rois of the recording
+            self.setRecording(audio)
+        elif audio is not None:
+            self.setWindow(audio)
+        elif not (windowed and uri.split('.')[-1].lower() in seekable_extensions and
+                self.readWindow(uri, bucketName, iniSecs, endiSecs)):
+            self.setRecording(Rec(uri,tempFolder,bucketName,None,legacy=legacy))
 
-        if  'HasAudioData' in recording.status:
-            self.original = recording.original
-            self.sample_rate = recording.sample_rate
-            self.recording_sample_rate = recording.sample_rate
-            self.channs = recording.channs
-            self.samples = recording.samples
-            self.status = 'HasAudioData'
+        if  'HasAudioData' in self.status:
             self.iniT = iniSecs
             self.endT = endiSecs
             self.lowF = lowFreq
             self.highF = highFreq 
             self.uri = uri
         else:
-            self.status = recording.status
             return None
         dur = float(self.samples)/float(self.sample_rate)
         if dur < endiSecs:
             raise ValueError("endiSecs greater than recording duration")
         
-        if  'HasAudioData' in self.status:
+        if  'HasAudioData' in self.status and compute:
             self.spectrogram()
 
+    def setRecording(self, recording):
+        if 'HasAudioData' in recording.status:
+            self.original = recording.original
+            self.sample_rate = recording.sample_rate
+            self.recording_sample_rate = recording.sample_rate
+            self.channs = recording.channs
+            self.samples = recording.samples
+            self.status = 'HasAudioData'
+        else:
+            self.status = recording.status
+
+    def readWindow(self, uri, bucketName, iniSecs, endiSecs):
+        """Decodes only the ROI span of the recording, reading it from the bucket with
+        ranged GETs. Returns False when the file cannot be read this way."""
+        try:
+            window = decode_window(S3RangeFile(bucketName, uri), iniSecs, endiSecs)
+        except Exception:
+            return False
+        if window[2] == 0:
+            return False
+        self.setWindow(window)
+        return True
+
+    def setWindow(self, window):
+        "Uses a (data, sample_rate, frames, offset) window of decode_window as the audio"
+        data, sample_rate, frames, offset = window
+        self.original = data
+        self.offset = offset
+        self.sample_rate = sample_rate
+        self.recording_sample_rate = sample_rate
+        self.channs = 1
+        self.samples = frames
+        self.status = 'HasAudioData'
+
+    def result(self):
+        "The RoiResult of the roi, to send back instead of the Roizer"
+        return RoiResult(self.lowF, self.highF, self.sample_rate, self.spec, self.specRow, self.specRows)
+
     def getAudioSamples(self):
         return self.original
     
     def getSpectrogram(self):
-        if self.spec is not None:
+        "The spectrogram with all its rows, the ones out of the band are 0"
+        if self.spec is None:
              self.spectrogram()
-        return self.spec
+        z = numpy.zeros(shape=(self.specRows, self.spec.shape[1]))
+        z[self.specRow:(self.specRow + self.spec.shape[0]), :] = self.spec
+        return z
     
     def spectrogram(self):
-        
+        data, nfft, first, last = self.spectrogramBand()
+        self.setBand(magnitude_band(data, nfft*2, nfft, first, last))
+
+    def spectrogramBand(self):
+        """Returns (the samples of the roi, nfft, first row, last row) of the magnitude
+        spectrogram band to compute and pass to setBand"""
         initSample = int(math.floor(float((self.iniT)) * float((self.sample_rate))))
         endSample = int(math.floor(float((self.endT)) * float((self.sample_rate))))
-        if endSample >= len(self.original):
-           endSample = len(self.original) - 1
+        if endSample >= self.samples:
+           endSample = self.samples - 1
 
         maxHertzInRec = float(self.sample_rate)/2.0
         nfft = 512
@@ -83,41 +184,34 @@ class Roizer:
                 i = i + 1
             nfft = i
             targetrows = len(FREQUENCIES_44100)
-        data = self.original[initSample:endSample]
-        f, t, Sxx = spectrogram(
-                data,
-                fs=self.sample_rate,
-                nperseg=nfft*2,
-                noverlap=nfft,
-                window='hann',
-                scaling='spectrum',
-                mode='magnitude',
-            )
+        data = self.original[(initSample - self.offset):(endSample - self.offset)]
+        f = magnitude_freqs(nfft*2, self.sample_rate)
+        rows = len(f)
 
         # Ensure compatibility with 44100 Hz sample rate
         if self.sample_rate < 44100:
             self.sample_rate = 44100
 
-        # Filter frequencies below lowF and above highF
-        i = 0
-        while f[i] < self.lowF:
-            Sxx[i, :] = 0
-            i += 1
-
-        # Convert power to decibels in the passband
-        while f[i] < self.highF:
-            Sxx[i, :] = 10.0 * numpy.log10(Sxx[i, :].clip(min=1e-10)) + 38.0
-            i += 1
+        # Only the lowF-highF band is computed, every other row is 0
+        first, last = band_rows(f, self.lowF, self.highF)
+        self.bandLayout = (first, rows, targetrows)
+        return data, nfft, first, last
 
-        # Filter out frequencies above the desired range
-        while i < Sxx.shape[0]:
-            Sxx[i, :] = 0
-            i += 1
+    def setBand(self, magnitude):
+        "Sets the spectrogram from the magnitude band asked by spectrogramBand"
+        first, rows, targetrows = self.bandLayout
+        last = first + magnitude.shape[0]
+        Sxx = to_db(magnitude, 38.0)
 
-        # Flip and pad spectrogram to match desired target rows
-        Z = numpy.flipud(Sxx[1:(Sxx.shape[0] - 1), :])
-        z = numpy.zeros(shape=(targetrows, Sxx.shape[1]))
-        z[(targetrows - Sxx.shape[0] + 1):(targetrows - 1), :] = Z
-
-        self.spec = z
+        # Flip the band, dropping the DC and Nyquist rows, and place it in a spectrogram of
+        # the desired target rows. Only the band is kept, as float32
+        inner_first = max(first, 1)
+        inner_last = min(last, rows - 1)
+        self.specRows = targetrows
+        if inner_last > inner_first:
+            self.specRow = targetrows - inner_last
+            self.spec = numpy.flipud(Sxx[(inner_first - first):(inner_last - first), :]).astype(numpy.float32)
+        else:
+            self.specRow = 0
+            self.spec = numpy.zeros(shape=(0, Sxx.shape[1]), dtype=numpy.float32)
         
@@ -0,0 +1,70 @@
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+# skimage's structural_similarity defaults. The pinned scikit-image takes data_range
+# from the dtype range of float images (-1..1)
+DATA_RANGE = 2.0
+K1 = 0.01
+K2 = 0.03
+# bound on the (rows, offsets, columns) products computed at once, sized to stay in cache
+BATCH_BYTES = 1024 * 1024
+
+
+def box_mean(a, win_size, axes):
+    "Mean over every win_size window along each of axes ('valid' positions only)"
+    for axis in axes:
+        n = a.shape[axis] - win_size + 1
+        at = [slice(None)] * a.ndim
+        at[axis] = slice(0, n)
+        total = a[tuple(at)].copy()
+        # win_size shifted adds, exact up to rounding unlike a running sum
+        for k in range(1, win_size):
+            at[axis] = slice(k, k + n)
+            total += a[tuple(at)]
+        a = total / win_size
+    return a
+
+
+def sliding_ssim(spec, template, offsets, win_size=7):
+    """Mean SSIM of template against spec[:, j:(j+columns)] for every offset j, as
+    skimage.metrics.structural_similarity(spec[:, j:(j+columns)], template, win_size=win_size)
+    computes it. Local means and variances of spec are computed once for the whole
+    spectrogram and the cross term for a batch of offsets in one array operation."""
+    spec = numpy.asarray(spec, dtype=numpy.float64)
+    template = numpy.asarray(template, dtype=numpy.float64)
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    rows, columns = template.shape
+    if spec.shape[0] != rows:
+        raise ValueError("spec and template must have the same number of rows")
+    if win_size % 2 == 0 or win_size > min(rows, columns):
+        raise ValueError("win_size must be odd and fit in the template")
+    if len(offsets) and (offsets.min() < 0 or offsets.max() + columns > spec.shape[1]):
+        raise ValueError("offsets must keep the template inside spec")
+
+    NP = win_size ** 2
+    cov_norm = NP / (NP - 1.0)
+    C1 = (K1 * DATA_RANGE) ** 2
+    C2 = (K2 * DATA_RANGE) ** 2
+
+    # statistics over the whole spectrogram, position (r, c) is the window at spec[r:, c:]
+    ux = box_mean(spec, win_size, (0, 1))
+    vx = cov_norm * (box_mean(spec * spec, win_size, (0, 1)) - ux * ux)
+    uy = box_mean(template, win_size, (0, 1))[:, None, :]
+    vy = cov_norm * (box_mean(template * template, win_size, (0, 1))[:, None, :] - uy * uy)
+
+    # the same statistics seen from every offset, as views
+    inner = columns - win_size + 1
+    windows = sliding_window_view(spec, columns, axis=1)
+    uxWindows = sliding_window_view(ux, inner, axis=1)
+    vxWindows = sliding_window_view(vx, inner, axis=1)
+
+    sim = numpy.empty(len(offsets))
+    batch = max(1, BATCH_BYTES // (8 * rows * columns))
+    for b in range(0, len(offsets), batch):
+        o = offsets[b:(b + batch)]
+        uxy = box_mean(windows[:, o, :] * template[:, None, :], win_size, (0, 2))
+        mx = uxWindows[:, o, :]
+        vxy = cov_norm * (uxy - mx * uy)
+        S = ((2 * mx * uy + C1) * (2 * vxy + C2)) / ((mx ** 2 + uy ** 2 + C1) * (vxWindows[:, o, :] + vy + C2))
+        sim[b:(b + batch)] = S.mean(axis=(0, 2))
+    return sim
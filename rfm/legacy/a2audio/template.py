@@ -0,0 +1,68 @@
+import numpy
+from .bandspec import psd_freqs
+from .constants import FREQUENCIES_44100
+
+
+def template_rows(low, high, sample_rate, nfft=512):
+    """Rows (spechigh, speclow) of a species surface matched against a recording at
+    sample_rate. Recordings up to 44100Hz use the 44100Hz frequency table, higher
+    rates the rows of their own spectrogram"""
+    if sample_rate <= 44100:
+        freqs = FREQUENCIES_44100
+    else:
+        freqs = psd_freqs(nfft*2, sample_rate)
+    i = len(freqs) - 1
+    j = i
+    while freqs[i] > high and i>=0:
+        j = j -1
+        i = i -1
+
+    while freqs[j] > low and j>=0:
+        j = j -1
+    speclow = len(freqs) - j - 2
+    spechigh = len(freqs) - i - 2
+    if speclow >= len(freqs):
+        speclow = len(freqs)-1
+    if spechigh < 0:
+        spechigh = 0
+    return spechigh, speclow
+
+
+class CompiledTemplate:
+    """A species surface with the matching inputs derived from it. For each band of rows
+    the surface is sliced, its -10000 sentinels are filled with the band minimum and it
+    is scaled to an 8 bit image, once per job instead of once per recording."""
+
+    def __init__(self, surface):
+        if not isinstance(surface, (numpy.ndarray, numpy.generic, numpy.memmap)):
+            raise ValueError("surface must be a numpy.ndarray. Input was a "+str(type(surface)))
+        self.surface = surface
+        self.bands = {}
+
+    @property
+    def shape(self):
+        return self.surface.shape
+
+    def band(self, spechigh, speclow):
+        "Returns (surface rows spechigh:speclow without sentinels, the same rows as uint8), both read-only"
+        key = (int(spechigh), int(speclow))
+        if key not in self.bands:
+            self.bands[key] = self.compile(*key)
+        return self.bands[key]
+
+    def compile(self, spechigh, speclow):
+        matrix = numpy.copy(self.surface[spechigh:speclow,:])
+        unwanted = matrix == -10000
+        if unwanted.any():
+            matrix[unwanted] = numpy.min(matrix[~unwanted])
+        image = ((matrix-numpy.min(matrix))/(numpy.max(matrix)-numpy.min(matrix)))*255
+        image = image.astype('uint8')
+        matrix.setflags(write=False)
+        image.setflags(write=False)
+        return matrix, image
+
+    def precompile(self, low, high, sample_rates):
+        "Compiles the bands used by recordings at sample_rates"
+        for sample_rate in sample_rates:
+            self.band(*template_rows(low, high, sample_rate))
+        return self
@@ -1,65 +1,103 @@
-import os
-import boto3
 import csv
 from contextlib import closing
 
-from .roizer import Roizer
-from ..a2audio.recanalizer import Recanalizer
-from ..db import connect, update_job_progress
+from .roizer import roize
+from .reccache import get_cache
+from ..a2audio.recanalizer import Recanalizer, SharedRec, preflight_status
+from ..db import connect, get_recordings_metadata, insert_rec_errors, update_job_progress
+from ..storage import upload_file, config
 
-config = {
-    's3_access_key_id': os.getenv('AWS_ACCESS_KEY_ID'),
-    's3_secret_access_key': os.getenv('AWS_SECRET_ACCESS_KEY'),
-    's3_bucket_name': os.getenv('S3_BUCKET_NAME'),
-    's3_legacy_bucket_name': os.getenv('S3_LEGACY_BUCKET_NAME'),
-    's3_endpoint': os.getenv('S3_ENDPOINT')
-}
-
-def upload_file(local_path, key):
-    s3 = boto3.resource('s3', aws_access_key_id=config['s3_access_key_id'], 
-                        aws_secret_access_key=config['s3_secret_access_key'], endpoint_url=config['s3_endpoint'])
-    bucket = s3.Bucket(config['s3_legacy_bucket_name'])
-    bucket.upload_file(local_path, key, ExtraArgs={'ACL': 'public-read'})
-
-def roigen(line,tempFolder,jobId,log=None):
+# roizes the lines (training rois) of one recording, which is fetched once. Returns for each
+# line its [spectrogram, species_id_songtype_id], or 'err' when it cannot be roized
+def roigen_recording(lines,tempFolder,jobId,log=None):
     if log is not None:
-        log.write('roizing recording: '+line[7])
+        log.write('roizing {} rois of recording: {}'.format(len(lines), lines[0][7]))
+    results = [None] * len(lines)
+    valid = []
+    for (k, line) in enumerate(lines):
+        if len(line) < 8:
+            if log is not None:
+                log.write('cannot roize : '+line[7])
+            results[k] = 'err'
+        else:
+            valid.append(k)
     db = connect()
-    if len(line) < 8:
-        if log is not None:
-            log.write('cannot roize : '+line[7])
+    try:
+        if len(valid) > 0:
+            line = lines[valid[0]]
+            recuri = line[7]
+            legacy = line[8]
+            bucketName = config['s3_legacy_bucket_name'] if legacy else config['s3_bucket_name']
+            rois = [(float(lines[k][3]), float(lines[k][4]), float(lines[k][5]), float(lines[k][6])) for k in valid]
+            roizers = roize(recuri, tempFolder, bucketName, rois, legacy)
+            cache = get_cache()
+            if log is not None and cache is not None:
+                log.write('recording cache '+cache.stats())
+            errors = []
+            for (k, roi) in zip(valid, roizers):
+                line = lines[k]
+                if 'HasAudioData' not in roi.status:
+                    errors.append((int(line[0]), jobId, roi.status))
+                    if log is not None:
+                        log.write('cannot roize : '+line[7]+' '+ str(line[0])+','+str(jobId))
+                        log.write(roi.status)
+                    results[k] = 'err'
+                else:
+                    results[k] = [roi.result(),str(int(line[1]))+"_"+str(int(line[2]))]
+            # also sets the job state to processing
+            update_job_progress(db, jobId, len(valid))
+            if len(errors) > 0:
+                insert_rec_errors(db, errors)
+    finally:
         db.close()
-        return 'err'
-    recId = int(line[0])
-    roispeciesId = int(line[1])
-    roisongtypeId= int(line[2])
-    initTime = float(line[3])
-    endingTime = float(line[4])
-    lowFreq = float(line[5])
-    highFreq = float(line[6])
-    recuri = line[7]
-    legacy = line[8]
-    bucketName = config['s3_legacy_bucket_name'] if legacy else config['s3_bucket_name']
-    roi = Roizer(recuri,tempFolder,bucketName,initTime,endingTime,lowFreq,highFreq,legacy)
+    if log is not None:
+        log.write('done roizing: '+lines[0][7])
+    return results
 
-    with closing(db.cursor()) as cursor:
-        cursor.execute('update `jobs` set `state`="processing", `progress` = `progress` + 1 ,last_update = now() where `job_id` = '+str(jobId))
-        db.commit()
+# lines grouped by recording, as lists of line indexes. The recording is line[0]: its id in
+# training data lines, its uri in recnilize lines
+def group_by_recording(lines):
+    groups = {}
+    for (k, line) in enumerate(lines):
+        groups.setdefault(line[0], []).append(k)
+    return list(groups.values())
 
-    if 'HasAudioData' not in roi.status:
-        with closing(db.cursor()) as cursor:
-            cursor.execute('INSERT INTO `recordings_errors` (`recording_id`, `job_id`) VALUES ('+str(recId)+','+str(jobId)+') ')
-            db.commit()
-        db.close()
-        if log is not None:
-            log.write('cannot roize : '+line[7]+' '+ str(recId)+','+str(jobId))
-            log.write(roi.status)
-        return 'err'
-    else:            
+# the results of each group of lines back in the order of the lines
+def in_line_order(groups, results, count):
+    ordered = [None] * count
+    for (group, group_results) in zip(groups, results):
+        for (k, result) in zip(group, group_results):
+            ordered[k] = result
+    return ordered
+
+# recnilize lines whose recording cannot be analyzed with their pattern, known from the
+# recordings table before anything is downloaded
+def preflight(lines,patterns,jobId,log=None):
+    """Returns (the lines to recnilize, the 'err' results of the others). patterns maps the
+    species_id_songtype_id of a line to its pattern. The errors are inserted at once"""
+    db = connect()
+    try:
+        metadata = get_recordings_metadata(db, [int(line[5]) for line in lines])
+        kept = []
+        results = []
+        errors = []
+        for line in lines:
+            pattern = patterns[line[4]]
+            (sample_rate, duration) = metadata.get(int(line[5]), (None, None))
+            status = preflight_status(sample_rate, duration, pattern[3], pattern[0].shape[1], pattern[1])
+            if status is None:
+                kept.append(line)
+            else:
+                if log is not None:
+                    log.write('skipping recording: '+line[0]+', reason='+status)
+                errors.append((int(line[5]), jobId, '{} (sample rate {}, duration {})'.format(status, sample_rate, duration)))
+                results.append('err ' + status)
+        if len(errors) > 0:
+            insert_rec_errors(db, errors)
+            update_job_progress(db, jobId, len(errors))
+    finally:
         db.close()
-        if log is not None:
-            log.write('done roizing: '+line[7])
-        return [roi,str(roispeciesId)+"_"+str(roisongtypeId)]
+    return kept, results
 
 # line indexes
 # 0 = uri (required)
@@ -69,7 +107,7 @@ def roigen(line,tempFolder,jobId,log=None):
 # 4 = species_id_songtype_id (required)
 # 5 = recording_id (not required)
 # 6 = legacy (1, 0) (required)
-def recnilize(line,workingFolder,jobId,pattern,log=None,ssim=True,searchMatch=False, isRetrain=False):
+def recnilize(line,workingFolder,jobId,pattern,log=None,ssim=True,searchMatch=False, isRetrain=False, shared=None):
     if log is not None:
         log.write('recnilizing recording: '+line[0])
     recId = int(line[5])
@@ -88,10 +126,12 @@ def recnilize(line,workingFolder,jobId,pattern,log=None,ssim=True,searchMatch=Fa
         bucketBase = 'project_' + str(pid) + '/training_vectors/job_' + str(jobId) + '/'
     legacy = line[6]
     recBucketName = config['s3_legacy_bucket_name'] if legacy else config['s3_bucket_name']
-    recAnalized = Recanalizer(line[0], pattern[0], pattern[2], pattern[3], workingFolder,
+    # pattern[5] is the surface compiled once per job
+    surface = pattern[5] if len(pattern) > 5 else pattern[0]
+    recAnalized = Recanalizer(line[0], surface, pattern[2], pattern[3], workingFolder,
                               recBucketName, log, False, ssim, searchMatch, modelSampleRate=pattern[1], db=db,
                               rec_id=recId, job_id=jobId,
-                              legacy=legacy)
+                              legacy=legacy, shared=shared)
     if recAnalized.status == 'Processed':
         if isRetrain is False:
             recName = line[0].split('/')
@@ -122,3 +162,14 @@ def recnilize(line,workingFolder,jobId,pattern,log=None,ssim=True,searchMatch=Fa
             log.write('failed recnilizing: '+line[0]+', reason='+recAnalized.status)
         db.close()
         return 'err ' + recAnalized.status
+
+# recnilize for the lines of one recording, each matched against its pattern (patterns maps
+# the species_id_songtype_id of a line to its pattern). The recording is fetched, decoded and
+# resampled once and its spectrogram rows are shared by the patterns. Returns the result of
+# recnilize for each line
+def recnilize_recording(lines,workingFolder,jobId,patterns,log=None,ssim=True,searchMatch=False, isRetrain=False):
+    legacy = lines[0][6]
+    recBucketName = config['s3_legacy_bucket_name'] if legacy else config['s3_bucket_name']
+    with closing(SharedRec(lines[0][0], workingFolder, recBucketName, legacy, analyses=len(lines))) as shared:
+        return [recnilize(line,workingFolder,jobId,patterns[line[4]],log,ssim,searchMatch,isRetrain,shared)
+                for line in lines]
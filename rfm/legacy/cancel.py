@@ -0,0 +1,90 @@
+import os
+import tempfile
+import threading
+
+from .db import get_canceled_jobs, get_connection, set_job_canceled
+
+config = {
+    'cancel_poll_secs': float(os.getenv('CANCEL_POLL_SECS', '5')),
+}
+
+
+def cancel_flag(job_id):
+    "File whose existence tells the worker processes that a job was canceled"
+    return os.path.join(tempfile.gettempdir(), 'job_{}.canceled'.format(job_id))
+
+
+def is_canceled(job_id):
+    return os.path.exists(cancel_flag(job_id))
+
+
+class CancelWatcher:
+    """Polls the cancel requests of a run's jobs from a background thread of the parent
+    process, every `interval` seconds and with a single query. A canceled job is marked
+    as such and gets a flag file, so the workers check for cancellation with a stat
+    instead of a query. Used as a context manager it polls while the run is going on
+    and removes the flags afterwards."""
+
+    def __init__(self, job_ids, interval=None):
+        self.job_ids = list(job_ids)
+        self.interval = interval or config['cancel_poll_secs']
+        self.canceled = set()
+        self.stopped = threading.Event()
+        self.thread = None
+        for job_id in self.job_ids:
+            # left behind by an earlier run of the job
+            self.remove_flag(job_id)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        for job_id in self.job_ids:
+            self.remove_flag(job_id)
+        return False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        try:
+            db = get_connection()
+            try:
+                for job_id in get_canceled_jobs(db, self.job_ids) - self.canceled:
+                    set_job_canceled(db, job_id)
+                    self.cancel(job_id)
+            finally:
+                db.close()
+        except Exception:
+            # try again on the next poll
+            pass
+
+    def cancel(self, job_id):
+        open(cancel_flag(job_id), 'w').close()
+        self.canceled.add(job_id)
+
+    def all_canceled(self):
+        return len(self.canceled) == len(self.job_ids)
+
+    def until_canceled(self, items):
+        "Yields items until every job is canceled, so no new tasks get dispatched"
+        try:
+            for item in items:
+                if self.all_canceled():
+                    return
+                yield item
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+
+    def remove_flag(self, job_id):
+        try:
+            os.remove(cancel_flag(job_id))
+        except OSError:
+            pass
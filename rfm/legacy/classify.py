@@ -4,24 +4,35 @@ import shutil
 import os
 import traceback
 import multiprocessing
+import joblib
 from joblib import Parallel, delayed
 import pickle
-import csv
+import io
+import itertools
 import json
 import sys
+from collections import deque
+import numpy
 
 from .a2pyutils.logger import Logger
-from .a2audio.recanalizer import Recanalizer
-from .db import connect, get_classification_job_data, get_model_params, get_playlist, insert_rec_error, set_progress_params, update_job_error
-from .storage import upload_file, download_file, config as storage_config
+from .cancel import CancelWatcher, is_canceled
+from .a2audio.recanalizer import Recanalizer, SharedRec, preflight_status
+from .a2audio.template import CompiledTemplate
+from .prefetch import discard, fetch_recording, open_spool, prefetch
+from .progress import get_progress
+from .results import ResultSink
+from .db import add_job_progress, connect, get_classification_job_data, get_model_params, count_playlist, iter_playlist, get_classified_recordings, get_errored_recordings, set_progress_params, update_job_error
+from .storage import download_file, read_file, upload_fileobj, config as storage_config
 
 FORCE_SEQUENTIAL_EXECUTION = os.getenv('FORCE_SEQUENTIAL_EXECUTION') == '1'
+PREDICT_BATCH_SIZE = int(os.getenv('PREDICT_BATCH_SIZE', '4096'))
 
-classificationCanceled = False
+# models of the run loaded by this worker process, by models file
+workerModels = {}
 
 def exit_error(db, log, job_id, msg):
     log.write(msg)
-    update_job_error(db, msg, job_id)
+    update_job_error(db, job_id, msg)
     remove_working_folder(job_id)
     sys.exit(-1)
 
@@ -57,24 +68,68 @@ def cancel_status(db, job_id, rm_folder=None, quitj=True):
         else:
             return False
 
-def classify_rec(rec, model_specs, working_folder, log, job_id):
-    global classificationCanceled
-    if classificationCanceled:
-        return None
+def get_rec_bucket(rec):
+    return storage_config['s3_legacy_bucket_name'] if rec['legacy'] else storage_config['s3_bucket_name']
+
+def fetch_rec(rec, slot):
+    return fetch_recording(get_rec_bucket(rec), rec['uri'], slot)
+
+def dump_worker_models(models, working_folder):
+    """Writes the models as the workers use them (without their forests) to a file that
+    each worker loads once, so a task only carries the recording and the file name"""
+    models_file = working_folder+'models.joblib'
+    joblib.dump([dict(m, data=[None] + list(m['data'][1:])) for m in models], models_file)
+    return models_file
+
+def load_worker_models(models_file):
+    "The models of a run, loaded once per worker process with their arrays memory-mapped"
+    if models_file not in workerModels:
+        workerModels[models_file] = joblib.load(models_file, mmap_mode='r')
+    return workerModels[models_file]
+
+def task_bytes(*args):
+    "Size of the arguments of a task as they are sent to a worker"
+    return len(pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL))
+
+def classify_rec(rec, models, log, prefetched=None):
+    """Analyzes a recording with every model of the run (model specs with their job_id and
+    working_folder, or the file written by dump_worker_models). The recording is fetched,
+    decoded and resampled once and spectrogram rows are shared between the models.
+    Returns {job_id: result or None} for the jobs that classified it."""
+    shared = None
+    try:
+        if isinstance(models, str):
+            models = load_worker_models(models)
+        # cancellations are published by the CancelWatcher of the parent
+        active = [m for m in models if not is_canceled(m['job_id']) and m['job_id'] not in rec.get('done', ())]
+        if len(active) == 0:
+            return None
+        shared = SharedRec(rec['uri'], active[0]['working_folder'], get_rec_bucket(rec), rec['legacy'], prefetched, len(active))
+        results = {}
+        for model_specs in active:
+            results[model_specs['job_id']] = classify_rec_model(rec, shared, model_specs, log)
+        return results
+    finally:
+        if shared is not None:
+            shared.close()
+        # Rec frees the room of the prefetched body once read, this frees it when it wasn't
+        discard(prefetched)
+
+def classify_rec_model(rec, shared, model_specs, log):
+    job_id = model_specs['job_id']
+    working_folder = model_specs['working_folder']
     error_processing = False
-    db = connect()
-    if cancel_status(db,job_id,working_folder,False):
-        classificationCanceled = True
-        quit()
+    # the reason stored for the recording when it cannot be classified
+    error = None
     rec_analized = None
     model_data = model_specs['data']
     try:
         use_ssim = True
         if len(model_data) > 5:
             use_ssim = model_data[5]
-        bucket_name = storage_config['s3_legacy_bucket_name'] if rec['legacy'] else storage_config['s3_bucket_name']
+        bucket_name = get_rec_bucket(rec)
         rec_analized = Recanalizer(rec['uri'],
-                                  model_data[1],
+                                  model_specs['template'],
                                   float(model_data[2]),
                                   float(model_data[3]),
                                   working_folder,
@@ -83,52 +138,78 @@ def classify_rec(rec, model_specs, working_folder, log, job_id):
                                   False,
                                   use_ssim,
                                   modelSampleRate=model_specs['sample_rate'],
-                                  legacy=rec['legacy'])
+                                  legacy=rec['legacy'],
+                                  shared=shared)
         log.write('recAnalized {}'.format(rec_analized.status))
-        with contextlib.closing(db.cursor()) as cursor:
-            cursor.execute("""
-                UPDATE `jobs`
-                SET `progress` = `progress` + 1, last_update = NOW()
-                WHERE `job_id` = %s
-            """, [job_id])
-            db.commit()
+        get_progress().add(job_id)
     except Exception:
         error_processing = True
-        log.write('error rec analyzed {} '.format(traceback.format_exc()))
+        error = traceback.format_exc()
+        log.write('error rec analyzed {} '.format(error))
     log.write('finish')
     featvector = None
     fets = None
-    if rec_analized.status == 'Processed':
+    if rec_analized is not None and rec_analized.status == 'Processed':
         try:
             featvector = rec_analized.getVector()
             fets = rec_analized.features()
         except Exception:
             error_processing = True
-            log.write('error getting feature vectors {} '.format(traceback.format_exc()))
-    else:
+            error = traceback.format_exc()
+            log.write('error getting feature vectors {} '.format(error))
+    elif rec_analized is not None:
         error_processing = True
-    res = None
+        error = rec_analized.status
     log.write('FEATS COMPUTED')
-    if featvector is not None:
-        try:
-            clf = model_data[0]
-            res = clf.predict([fets])
-        except Exception:
-            error_processing = True
-            log.write('error predicting {} '.format(traceback.format_exc()))
-    else:
+    if featvector is None:
         error_processing = True
     if error_processing:
-        try:
-            insert_rec_error(db,rec['recording_id'],job_id)
-        except Exception:
-            exit_error(db, log, job_id, "Could not insert recording error, {}".format(traceback.format_exc()))
-        db.close()
-        return None
+        # stored by the parent with the other results of the job
+        return {'id':rec['recording_id'],'err':error or 'no feature vector'}
     else:
         log.write('done processing this rec')
-        db.close()
-        return {'uri':rec['uri'],'id':rec['recording_id'],'f':featvector,'ft':fets,'r':res[0]}
+        # the presence is predicted in the parent, for all the recordings at once
+        return {'uri':rec['uri'],'id':rec['recording_id'],'f':featvector,'ft':fets}
+
+
+def predict_results(model_specs, results, num_cores, log):
+    """Sets the presence ('r') and its probability ('p') of every result with one
+    vectorized predict per chunk of PREDICT_BATCH_SIZE recordings, on num_cores threads.
+    Recordings whose features cannot be scored are turned into errors."""
+    clf = model_specs['data'][0]
+    if hasattr(clf, 'n_jobs'):
+        # the forests are pickled with n_jobs=-1
+        clf.n_jobs = num_cores
+    scored = [r for r in results if r and 'ft' in r]
+    for c in range(0, len(scored), PREDICT_BATCH_SIZE):
+        chunk = scored[c:(c + PREDICT_BATCH_SIZE)]
+        try:
+            presence, probability = predict_rows(clf, [r['ft'] for r in chunk])
+        except Exception:
+            log.write('error predicting a batch, predicting its recordings one by one {} '.format(traceback.format_exc()))
+            presence = []
+            probability = []
+            for r in chunk:
+                try:
+                    (r_presence,), (r_probability,) = predict_rows(clf, [r['ft']])
+                except Exception:
+                    log.write('error predicting {} '.format(traceback.format_exc()))
+                    r_presence = None
+                    r_probability = None
+                    r['err'] = traceback.format_exc()
+                presence.append(r_presence)
+                probability.append(r_probability)
+        for (r, r_presence, r_probability) in zip(chunk, presence, probability):
+            r['r'] = r_presence
+            r['p'] = r_probability
+    return [r if r and (r.get('r') is not None or 'err' in r) else None for r in results]
+
+
+def predict_rows(clf, rows):
+    "Predictions of clf and the probability of each predicted class, as clf.predict would return them"
+    proba = clf.predict_proba(rows)
+    best = proba.argmax(axis=1)
+    return clf.classes_.take(best, axis=0), proba[numpy.arange(len(rows)), best]
 
 
 def get_model(db, model_specs, log, working_folder, job_id):
@@ -181,95 +262,164 @@ def get_model(db, model_specs, log, working_folder, job_id):
             model_specs["sample_rate"] = cursor.fetchone()[0]
         log.write('model sampling rate is {}'.format(model_specs["sample_rate"]))
 
+    # the template only depends on the model, compile it once for all the recordings
+    model_specs['template'] = CompiledTemplate(model_specs['data'][1]).precompile(
+        float(model_specs['data'][2]), float(model_specs['data'][3]), {int(model_specs['sample_rate']), 44100})
+    log.write('model template compiled.')
+
     return model_specs
 
-def write_vector(rec_uri, temp_folder, featvector):
-    vector_local = None
+class JobResults:
+    """Consumes the results of one job as the recordings finish: they are predicted in
+    chunks of PREDICT_BATCH_SIZE and stored by a ResultSink, so memory doesn't grow with
+    the playlist and an interrupted job keeps the results it stored. The vector stats
+    are checkpointed before each batch of results is written, for a resumed job to
+    start from (done is the number of recordings it classified before)."""
+
+    def __init__(self, model_specs, num_cores, log, done=0):
+        self.model_specs = model_specs
+        self.job_id = model_specs['job_id']
+        self.num_cores = num_cores
+        self.log = log
+        self.processed = done
+        self.min_vector_val = 9999999.0
+        self.max_vector_val = -9999999.0
+        if done > 0:
+            stats = load_checkpoint(model_specs['uri'], self.job_id)
+            if stats is None:
+                log.write('no stats checkpoint of job #{}, stats only cover this run'.format(self.job_id))
+            else:
+                self.min_vector_val = stats['minv']
+                self.max_vector_val = stats['maxv']
+        self.pending = []
+        self.progress = get_progress()
+        self.db = connect()
+        self.sink = ResultSink(self.db, self.job_id, model_specs['species'], model_specs['songtype'],
+                               checkpoint=self.checkpoint, log=log)
+
+    def add(self, result, steps=1):
+        self.progress.add(self.job_id, steps)
+        if result:
+            self.pending.append(result)
+        if len(self.pending) >= PREDICT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        pending = self.pending
+        self.pending = []
+        try:
+            for r in predict_results(self.model_specs, pending, self.num_cores, self.log):
+                self.store(r)
+        except Exception:
+            exit_error(self.db, self.log, self.job_id, 'cannot process results. {}'.format(traceback.format_exc()))
+
+    def store(self, r):
+        if r and 'err' in r:
+            self.sink.add_error(r['id'], r['err'])
+        elif r and 'id' in r:
+            self.processed = self.processed + 1
+            rec_name = r['uri'].split('/')
+            rec_name = rec_name[len(rec_name)-1]
+            maxv = max(r['f'])
+            minv = min(r['f'])
+            if self.min_vector_val > float(minv):
+                self.min_vector_val = minv
+            if self.max_vector_val < float(maxv):
+                self.max_vector_val = maxv
+            vector_uri = '{}/classification_{}_{}.vector'.format(
+                    self.model_specs['uri'].replace('.mod', ''), self.job_id, rec_name
+            )
+            self.sink.upload_vector(vector_uri, r['f'], r['id'])
+            self.log.write("inserting results from {rid} for {sp} {st} into the database ({r}, p:{p}, maxv:{maxv})".format(
+                rid=r['id'],
+                r=r['r'],
+                p=r.get('p'),
+                sp=self.model_specs['species'],
+                st=self.model_specs['songtype'],
+                maxv=maxv
+            ))
+            self.sink.add_result(r['id'], r['r'], maxv)
+
+    def stats(self):
+        return {"minv": float(self.min_vector_val), "maxv": float(self.max_vector_val)}
+
+    def checkpoint(self, rows):
+        # the stats cover every stored result and maybe some that are not stored yet,
+        # which a resumed job computes again with the same values
+        upload_fileobj(io.BytesIO(json.dumps(self.stats()).encode()), checkpoint_uri(self.model_specs['uri'], self.job_id))
+
+    def close(self, discard=False):
+        """Stores the pending results, returns {t: recordings processed, stats: vector stats}.
+        The pending results of a canceled job (discard) are dropped instead"""
+        if discard:
+            self.pending = []
+        else:
+            self.flush()
+        try:
+            self.sink.close(discard)
+            self.progress.flush()
+        except Exception:
+            exit_error(self.db, self.log, self.job_id, 'cannot process results. {}'.format(traceback.format_exc()))
+        self.db.close()
+        return {"t":self.processed,"stats":self.stats()}
+
+def checkpoint_uri(model_uri, job_id):
+    return '{}/classification_{}.checkpoint'.format(model_uri.replace('.mod', ''), job_id)
+
+def load_checkpoint(model_uri, job_id):
+    "The vector stats checkpointed by a previous run of job_id, None if there are none"
     try:
-        rec_name = rec_uri.split('/')
-        rec_name = rec_name[len(rec_name)-1]
-        vector_local = temp_folder+rec_name+'.vector'
-        file = open(vector_local, 'w')
-        wr = csv.writer(file)
-        wr.writerow(featvector)
-        file.close()
+        return json.loads(read_file(checkpoint_uri(model_uri, job_id)))
     except Exception:
-        print('ERROR writing {}'.format(traceback.format_exc()))
         return None
-    return vector_local
 
-def upload_vector(uri,filen,rid,db,job_id):
-    try:
-        upload_file(filen, uri)
-        os.remove(filen)
-    except Exception:
-        insert_rec_error(db, rid, job_id)
+def pending_recordings(recs, done):
+    """The recordings that some job of the run still has to classify. done maps each job
+    to the recordings it classified or failed before, the jobs that skip a recording are
+    in its 'done'"""
+    for rec in recs:
+        rec_done = [j for j in done if rec['recording_id'] in done[j]]
+        if len(rec_done) == len(done):
+            continue
+        if len(rec_done) > 0:
+            rec = dict(rec, done=rec_done)
+        yield rec
 
-def insert_result_to_db(db, job_id, rec_id, species, songtype, presence, max_v):
-    try:
-        with contextlib.closing(db.cursor()) as cursor:
-            cursor.execute("""
-                INSERT INTO `classification_results` (
-                    job_id, recording_id, species_id, songtype_id, present,
-                    max_vector_value
-                ) VALUES (%s, %s, %s, %s, %s, %s)
-            """, [job_id, rec_id, species, songtype, presence, float(max_v)])
-            db.commit()
-    except Exception:
-        print('ERROR writing {}'.format(traceback.format_exc()))
-        insert_rec_error(db, rec_id, job_id)
+def preflight(recs, models, rejected):
+    """Leaves the jobs that cannot process a recording, as its sample_rate and duration show,
+    out of its 'done' and appends (job_id, recording_id, reason) to rejected. Recordings
+    that no job can process are not yielded, so they are neither downloaded nor analyzed"""
+    for rec in recs:
+        skipped = list(rec.get('done', ()))
+        for model_specs in models:
+            if model_specs['job_id'] in skipped:
+                continue
+            status = preflight_status(rec.get('sample_rate'), rec.get('duration'), float(model_specs['data'][3]),
+                                      model_specs['data'][1].shape[1], model_specs['sample_rate'])
+            if status is not None:
+                rejected.append((model_specs['job_id'], rec['recording_id'], '{} (sample rate {}, duration {})'.format(
+                    status, rec.get('sample_rate'), rec.get('duration'))))
+                skipped.append(model_specs['job_id'])
+        if len(skipped) == len(models):
+            continue
+        if len(skipped) > len(rec.get('done', ())):
+            rec = dict(rec, done=skipped)
+        yield rec
 
-def process_results(res, working_folder, model_uri, job_id, species, songtype, db, log):
-    min_vector_val = 9999999.0
-    max_vector_val = -9999999.0
-    processed = 0
-    try:
-        for r in res:
-            with contextlib.closing(db.cursor()) as cursor:
-                cursor.execute("""
-                    UPDATE `jobs`
-                    SET `progress` = `progress` + 1, last_update = NOW()
-                    WHERE `job_id` = %s
-                """, [job_id])
-                db.commit()
-            if r and 'id' in r:
-                processed = processed + 1
-                rec_name = r['uri'].split('/')
-                rec_name = rec_name[len(rec_name)-1]
-                local_file = write_vector(r['uri'],working_folder,r['f'])
-                if local_file is not None:
-                    maxv = max(r['f'])
-                    minv = min(r['f'])
-                    if min_vector_val > float(minv):
-                        min_vector_val = minv
-                    if max_vector_val < float(maxv):
-                        max_vector_val = maxv
-                    vector_uri = '{}/classification_{}_{}.vector'.format(
-                            model_uri.replace('.mod', ''), job_id, rec_name
-                    )
-                    upload_vector(vector_uri,local_file,r['id'],db,job_id)
-                    log.write("inserting results from {rid} for {sp} {st} into the database ({r}, maxv:{maxv})".format(
-                        rid=r['id'],
-                        r=r['r'],
-                        sp=species,
-                        st=songtype,
-                        maxv=maxv
-                    ))
-                    insert_result_to_db(db, job_id,r['id'], species, songtype,r['r'],maxv)
-                else:
-                    log.write('localFile is None')
-                    insert_rec_error(db, r['id'], job_id)
-    except Exception:
-        exit_error(db, log, job_id, 'cannot process results. {}'.format(traceback.format_exc()))
-    return {"t":processed,"stats":{"minv": float(min_vector_val), "maxv": float(max_vector_val)}}
+def store_rejected(streams, rejected, canceled):
+    "Stores the errors of the recordings ruled out by preflight with the results of their jobs"
+    while len(rejected) > 0:
+        (job_id, rec_id, reason) = rejected.popleft()
+        for stream in streams:
+            if stream.job_id == job_id and job_id not in canceled:
+                # both progress steps of the recording, no worker took the first one
+                stream.add({'id': rec_id, 'err': reason}, 2)
 
 def run_classification(job_id):
-    global classificationCanceled
+    return run_classifications([job_id])
 
-    log = Logger(job_id, 'classification.py', 'main')
-    log.also_print = True
-    
-    db = connect()
+def prepare_job(db, log, job_id):
+    "Fetches the job data and the model of a classification job, returns (playlist_id, ncpu, model_specs)"
     try:
         (classifier_id, _, _, _, playlist_id, ncpu) = get_classification_job_data(db, job_id)
     except Exception:
@@ -285,62 +435,159 @@ def run_classification(job_id):
     if model_specs['model_type_id'] != 4:
         log.write("unknown model type requested")
         sys.exit(-1)
+    return playlist_id, ncpu, model_specs
+
+def run_classifications(job_ids):
+    """Runs classification jobs that share a playlist in a single pass over its recordings:
+    each recording is fetched and transformed once and matched against every job's model.
+    Results, progress and stats are still written per job, as the recordings finish.
+    A job that was run before only classifies the recordings it has no results for."""
+    job_id = job_ids[0]
+    log = Logger(job_id, 'classification.py', 'main')
+    log.also_print = True
+    if len(job_ids) > 1:
+        log.write('multi-model run of jobs {}'.format(job_ids))
+
+    db = connect()
+    jobs = [prepare_job(db, log, j) for j in job_ids]
+    playlist_id = jobs[0][0]
+    ncpu = jobs[0][1]
+    for (j, (other_playlist_id, _, _)) in zip(job_ids, jobs):
+        if other_playlist_id != playlist_id:
+            exit_error(db, log, j, 'job #{} does not share the playlist of job #{}'.format(j, job_id))
 
     num_cores = multiprocessing.cpu_count()
     if int(ncpu) > 0:
         num_cores = int(ncpu)
     
-    working_folder = get_working_folder(job_id)
+    for j in job_ids:
+        get_working_folder(j)
     log.write('created working directory')
     try:
-        recs = get_playlist(db, playlist_id)
+        total = count_playlist(db, playlist_id)
+        # the recordings are read page by page as they are dispatched
+        recs = iter_playlist(playlist_id)
+        first = next(recs, None)
     except Exception:
         exit_error(db, log, job_id, "could not get playlist, {}".format(traceback.format_exc()))
-    if len(recs) < 1:
+    if total < 1 or first is None:
         exit_error(db, log, job_id, 'no recordings in playlist, {}'.format(traceback.format_exc()))
-    log.write('playlist generated')
-    try:
-        set_progress_params(db,len(recs), job_id)
-    except Exception:
-        exit_error(db, log, job_id, "could not set progress params, {}".format(traceback.format_exc()))
+    recs = itertools.chain([first], recs)
+    log.write('playlist of {} recordings opened'.format(total))
+    for j in job_ids:
+        try:
+            set_progress_params(db,total, j)
+        except Exception:
+            exit_error(db, log, j, "could not set progress params, {}".format(traceback.format_exc()))
     log.write('job progress set to start')
-    model_specs = get_model(db, model_specs, log, working_folder, job_id)
+    models = []
+    for (j, (_, _, model_specs)) in zip(job_ids, jobs):
+        working_folder = get_working_folder(j)
+        model_specs = get_model(db, model_specs, log, working_folder, j)
+        model_specs['job_id'] = j
+        model_specs['working_folder'] = working_folder
+        models.append(model_specs)
     log.write('model was fetched')
-    cancel_status(db, job_id, working_folder)
+    done = {}
+    classified = {}
+    for j in job_ids:
+        try:
+            classified[j] = get_classified_recordings(db, j)
+            # their errors are stored already, they are not tried again
+            errored = get_errored_recordings(db, j) - classified[j]
+            done[j] = classified[j] | errored
+            if len(done[j]) > 0:
+                log.write('job #{} resumes, {} recordings were classified and {} failed before'.format(
+                    j, len(classified[j]), len(errored)))
+                # 2 progress steps per recording, see set_progress_params
+                add_job_progress(db, j, 2 * len(done[j]))
+        except Exception:
+            exit_error(db, log, j, "could not get previous results, {}".format(traceback.format_exc()))
+    watcher = CancelWatcher(job_ids)
+    for model_specs in models:
+        if cancel_status(db, model_specs['job_id'], model_specs['working_folder'], len(models) == 1):
+            watcher.cancel(model_specs['job_id'])
     db.close()
+    if watcher.all_canceled():
+        return False
+
+    # the workers only extract features, the forests stay in this process
+    models_file = dump_worker_models(models, models[0]['working_folder'])
+    # the forests are not pickled again to be measured, the size of their model files stands for them
+    log.write('bytes sent per task: {} with the models file ({} once per worker), models inline added {} bytes of model files'.format(
+        task_bytes(first, models_file, log), os.path.getsize(models_file),
+        sum(os.path.getsize(m['working_folder']+'model.mod') for m in models)))
 
     log.write('starting parallel classify of recs')
+    streams = [JobResults(model_specs, num_cores, log, len(classified[model_specs['job_id']])) for model_specs in models]
+    # filled while the tasks are dispatched (by a joblib thread), drained here
+    rejected = deque()
+    # joblib runs a single worker in this process, the bodies downloaded ahead then stay in memory
+    spool = open_spool(models[0]['working_folder'], FORCE_SEQUENTIAL_EXECUTION or num_cores == 1)
+    log.write('recordings downloaded ahead are kept in {}'.format(spool.folder or 'memory'))
     try:
-        if FORCE_SEQUENTIAL_EXECUTION:
-            log.write('sequential mode for testing')
-            results = []
-            for rec in recs:
-                result = classify_rec(rec, model_specs, working_folder, log, job_id)
-                results.append(result)
-        else:
-            results = Parallel(n_jobs=num_cores)(
-                delayed(classify_rec)(rec, model_specs, working_folder, log, job_id) for rec in recs
-            )
+        with watcher:
+            # I/O threads download the next recordings while the workers process the current ones,
+            # no more recordings are dispatched once every job is canceled
+            tasks = watcher.until_canceled(prefetch(preflight(pending_recordings(recs, done), models, rejected), fetch_rec, spool))
+            if FORCE_SEQUENTIAL_EXECUTION:
+                log.write('sequential mode for testing')
+                results = (classify_rec(rec, models_file, log, prefetched) for rec, prefetched in tasks)
+            else:
+                # the results are stored in the order they finish
+                results = Parallel(n_jobs=num_cores, return_as='generator_unordered')(
+                    delayed(classify_rec)(rec, models_file, log, prefetched)
+                    for rec, prefetched in tasks
+                )
+            for result in results:
+                store_rejected(streams, rejected, watcher.canceled)
+                for stream in streams:
+                    if result and stream.job_id in result and stream.job_id not in watcher.canceled:
+                        stream.add(result[stream.job_id])
+            store_rejected(streams, rejected, watcher.canceled)
     except Exception:
         log.write('ERROR::parallel classify_rec {}'.format(traceback.format_exc()))
-        if classificationCanceled:
+        if watcher.all_canceled():
             log.write('job cancelled')
+        # keep what was classified, a new run of the jobs resumes from there
+        for stream in streams:
+            stream.close(stream.job_id in watcher.canceled)
         return False
+    finally:
+        spool.remove()
     log.write('done parallel classify')
-    
-    db = connect()
-    cancel_status(db, job_id, working_folder)
+
+    completed = True
+    for stream in streams:
+        completed = complete_job(stream, log, len(models) == 1, stream.job_id in watcher.canceled) and completed
+    return completed
+
+def complete_job(stream, log, standalone=True, canceled=False):
+    """Stores the last results of one job (its JobResults), its stats and marks it completed.
+    The results a canceled job has not written yet are dropped. In a multi-model run (not
+    standalone) a canceled or failed job doesn't end the process"""
+    job_id = stream.job_id
+    working_folder = stream.model_specs['working_folder']
     try:
-        stats = process_results(results, working_folder, model_specs['uri'], job_id, model_specs['species'], model_specs['songtype'], db, log)
+        stats = stream.close(canceled)
     except Exception:
         log.write('ERROR:: {}'.format(traceback.format_exc()))
         return False
+    db = connect()
+    if cancel_status(db, job_id, working_folder, standalone):
+        db.close()
+        return False
     log.write('computed stats')
     shutil.rmtree(working_folder)
     log.write('removed folder')
     stats_json = stats['stats']
     if stats['t'] < 1:
-        exit_error(db, log, job_id, 'no recordings processed. {}'.format(traceback.format_exc()))
+        if standalone:
+            exit_error(db, log, job_id, 'no recordings processed. {}'.format(traceback.format_exc()))
+        log.write('no recordings processed for job #{}'.format(job_id))
+        update_job_error(db, job_id, 'no recordings processed.')
+        db.close()
+        return False
     try:
         with contextlib.closing(db.cursor()) as cursor:
             cursor.execute("""
@@ -361,6 +608,3 @@ def run_classification(job_id):
         db.close()
         log.write('ERROR:: {}'.format(traceback.format_exc()))
         return False
-
-
-        
@@ -1,7 +1,8 @@
 import json
 import os
+import threading
 import mysql.connector
-import traceback
+import mysql.connector.pooling
 from contextlib import closing
 
 config = {
@@ -10,8 +11,14 @@ config = {
     'db_user': os.getenv('DB_USER'),
     'db_password': os.getenv('DB_PASSWORD'),
     'db_name': os.getenv('DB_NAME'),
+    'db_pool_size': int(os.getenv('DB_POOL_SIZE', '4')),
+    'playlist_page_size': int(os.getenv('PLAYLIST_PAGE_SIZE', '10000')),
 }
 
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
 def connect():
     return mysql.connector.connect(
         host=config['db_host'],
@@ -21,6 +28,27 @@ def connect():
         database=config['db_name']
     )
 
+def get_connection():
+    """Returns a connection from the pool of the current process. Closing it gives it back
+    to the pool, so workers don't open a new connection for every recording."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name='rfm_{}'.format(pid),
+                    pool_size=config['db_pool_size'],
+                    # nothing is kept in the session, skip the reset round trip
+                    pool_reset_session=False,
+                    host=config['db_host'],
+                    port=config['db_port'],
+                    user=config['db_user'],
+                    password=config['db_password'],
+                    database=config['db_name'])
+                _pool_pid = pid
+    return _pool.get_connection()
+
 def get_training_job(db, job_id):
     with closing(db.cursor()) as cursor:
         cursor.execute("""
@@ -164,6 +192,15 @@ def update_job_progress(db, job_id: int, progress_increment = 1):
         """, [progress_increment, job_id])
         db.commit()
 
+def add_job_progress(db, job_id, progress_increment):
+    with closing(db.cursor()) as cursor:
+        cursor.execute("""
+            UPDATE `jobs`
+            SET `progress` = `progress` + %s, last_update = NOW()
+            WHERE `job_id` = %s
+        """, [progress_increment, job_id])
+        db.commit()
+
 def set_progress_params(db, progress_steps, job_id):
     with closing(db.cursor()) as cursor:
         cursor.execute("""
@@ -173,6 +210,25 @@ def set_progress_params(db, progress_steps, job_id):
         """, [progress_steps*2+5, job_id])
         db.commit()
 
+def get_canceled_jobs(db, job_ids):
+    "The jobs of job_ids with a pending cancel request"
+    with closing(db.cursor()) as cursor:
+        cursor.execute("""
+            SELECT `job_id`
+            FROM `jobs`
+            WHERE `job_id` IN ({}) AND `cancel_requested` > 0
+        """.format(', '.join(['%s'] * len(job_ids))), list(job_ids))
+        return set(job_id for (job_id,) in cursor)
+
+def set_job_canceled(db, job_id):
+    with closing(db.cursor()) as cursor:
+        cursor.execute("""
+            UPDATE `jobs`
+            SET `state` = "canceled", last_update = now()
+            WHERE `job_id` = %s
+        """, [job_id])
+        db.commit()
+
 def get_classification_job_data(db, job_id):
     with closing(db.cursor()) as cursor:
         cursor.execute("""
@@ -201,22 +257,90 @@ def get_model_params(db, classifier_id):
         'songtype': songtype_id,
     }
 
-def get_playlist(db, playlist_id):
-    recs = []
+def get_classified_recordings(db, job_id):
+    "Ids of the recordings that already have a classification result of job_id"
+    with closing(db.cursor()) as cursor:
+        cursor.execute("""
+            SELECT `recording_id` FROM `classification_results` WHERE `job_id` = %s
+        """, [job_id])
+        return set(r_id for (r_id,) in cursor)
+
+def get_errored_recordings(db, job_id):
+    "Ids of the recordings that already have a recordings_errors row of job_id"
+    with closing(db.cursor()) as cursor:
+        cursor.execute("""
+            SELECT DISTINCT `recording_id` FROM `recordings_errors` WHERE `job_id` = %s
+        """, [job_id])
+        return set(r_id for (r_id,) in cursor)
+
+def count_playlist(db, playlist_id):
     with closing(db.cursor()) as cursor:
         cursor.execute("""
-            SELECT r.`recording_id`, r.`uri`, IF(LEFT(r.uri, 8) = 'project_', 1, 0) legacy
-            FROM `recordings` r JOIN `playlist_recordings` pr ON r.`recording_id` = pr.`recording_id`
-            WHERE pr.`playlist_id` = %s
+            SELECT COUNT(*) FROM `playlist_recordings` WHERE `playlist_id` = %s
         """, [playlist_id])
-        recs = [{"recording_id": r_id, "uri": uri, "legacy": legacy} for (r_id, uri, legacy) in cursor]
-    return recs
+        (count,) = cursor.fetchone()
+    return count
 
-def insert_rec_error(db, rec_id, job_id):
-    error = traceback.format_exc()
+def iter_playlist(playlist_id, page_size=None):
+    """Yields the recordings of a playlist ({recording_id, uri, legacy, sample_rate, duration}),
+    in recording_id order. They are read a page at a time (keyset pagination on
+    recording_id) as the consumer gets to them, each page on a pooled connection"""
+    page_size = page_size or config['playlist_page_size']
+    last_id = 0
+    while True:
+        db = get_connection()
+        try:
+            with closing(db.cursor()) as cursor:
+                # a page (at most page_size rows) is read whole, so the connection goes back
+                # to the pool before the consumer gets to its recordings
+                cursor.execute("""
+                    SELECT r.`recording_id`, r.`uri`, IF(LEFT(r.uri, 8) = 'project_', 1, 0) legacy,
+                        r.`sample_rate`, r.`duration`
+                    FROM `recordings` r JOIN `playlist_recordings` pr ON r.`recording_id` = pr.`recording_id`
+                    WHERE pr.`playlist_id` = %s AND r.`recording_id` > %s
+                    ORDER BY r.`recording_id`
+                    LIMIT %s
+                """, [playlist_id, last_id, page_size])
+                page = [{"recording_id": r_id, "uri": uri, "legacy": legacy, "sample_rate": sample_rate, "duration": duration}
+                        for (r_id, uri, legacy, sample_rate, duration) in cursor]
+        finally:
+            db.close()
+        for rec in page:
+            yield rec
+        if len(page) < page_size:
+            return
+        last_id = page[-1]['recording_id']
+
+def get_recordings_metadata(db, rec_ids):
+    "Returns {recording_id: (sample_rate, duration)} of the recordings rec_ids, in one query"
+    rec_ids = list(set(rec_ids))
+    if len(rec_ids) == 0:
+        return {}
     with closing(db.cursor()) as cursor:
         cursor.execute("""
+            SELECT `recording_id`, `sample_rate`, `duration`
+            FROM `recordings`
+            WHERE `recording_id` IN ({})
+        """.format(', '.join(['%s'] * len(rec_ids))), rec_ids)
+        return {r_id: (sample_rate, duration) for (r_id, sample_rate, duration) in cursor}
+
+def insert_rec_errors(db, rows):
+    "Inserts (rec_id, job_id, error) rows into recordings_errors in one transaction"
+    with closing(db.cursor()) as cursor:
+        cursor.executemany("""
             INSERT INTO `recordings_errors`(`recording_id`, `job_id`, `error`)
             VALUES (%s, %s, %s)
-        """, [rec_id, job_id, error])
+        """, rows)
+        db.commit()
+
+def insert_classification_results(db, rows):
+    """Inserts (job_id, rec_id, species, songtype, presence, max_v) rows into
+    classification_results in one transaction, as a multi-row INSERT"""
+    with closing(db.cursor()) as cursor:
+        cursor.executemany("""
+            INSERT INTO `classification_results` (
+                job_id, recording_id, species_id, songtype_id, present,
+                max_vector_value
+            ) VALUES (%s, %s, %s, %s, %s, %s)
+        """, rows)
         db.commit()
@@ -0,0 +1,309 @@
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .a2audio.rec import config as rec_config
+from .a2audio.reccache import get_cache, config as cache_config
+from .storage_client import get_client
+
+config = {
+    'prefetch_depth': int(os.getenv('PREFETCH_DEPTH', '16')),
+    'prefetch_threads': int(os.getenv('PREFETCH_THREADS', '8')),
+    'prefetch_max_bytes': int(os.getenv('PREFETCH_MAX_BYTES', str(512 * 1024 ** 2))),
+}
+
+# seconds between two looks for the spool files read by the workers while a download waits for room
+SPOOL_POLL_SECS = 0.05
+# memory-backed filesystem the spool of workers in other processes is kept in
+SHM_FOLDER = '/dev/shm'
+
+
+def open_spool(job_folder, in_process=False, max_bytes=None):
+    """The Spool of a run. The bodies stay in memory when the workers run in this process,
+    they are written to SHM_FOLDER for workers in other processes (bounded by half its free
+    space, joblib also memory-maps big arguments there) and to the job folder when there is
+    no SHM_FOLDER"""
+    max_bytes = max_bytes or config['prefetch_max_bytes']
+    if in_process:
+        return Spool(None, max_bytes)
+    if os.path.isdir(SHM_FOLDER) and os.access(SHM_FOLDER, os.W_OK):
+        stats = os.statvfs(SHM_FOLDER)
+        free = stats.f_bavail * stats.f_frsize // 2
+        if free > 0:
+            return Spool(tempfile.mkdtemp(prefix='prefetch_', dir=SHM_FOLDER) + '/', min(max_bytes, free))
+    return Spool(job_folder + 'prefetch/', max_bytes)
+
+
+class Spool:
+    """Where the recordings downloaded ahead are kept until a worker reads them: in memory
+    (folder None) for workers of this process, or as files of folder, so a worker in
+    another process is sent the path of a body instead of the body itself. Room for a
+    body is reserved before it is downloaded, in the order of the items, and freed once
+    the worker has read it: the downloads in progress and the bodies already dispatched
+    add up to at most max_bytes (a single bigger body is let through when the spool is
+    empty). Workers in other processes free the room of a file by deleting it, a
+    download waiting for room looks for the deleted files every SPOOL_POLL_SECS."""
+
+    def __init__(self, folder=None, max_bytes=None):
+        self.folder = folder
+        self.max_bytes = max_bytes or config['prefetch_max_bytes']
+        if self.max_bytes < 1:
+            raise ValueError("max_bytes must be positive")
+        if folder is not None and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.condition = threading.Condition()
+        self.next_slot = 0
+        # slots that have neither reserved room nor given up their turn
+        self.waiting = set()
+        # slots whose item the consumer got to, they no longer wait for room
+        self.skipped = set()
+        # bytes by key (the path of a file, the slot number of a body in memory), of the
+        # downloads in progress and of the bodies not read yet
+        self.downloading = {}
+        self.written = {}
+        self.closed = False
+
+    def slot(self):
+        "The place of the next item in the order rooms are reserved"
+        with self.condition:
+            slot = SpoolSlot(self, self.next_slot)
+            self.waiting.add(slot.number)
+            self.next_slot += 1
+            return slot
+
+    def used(self):
+        "Bytes reserved, forgetting the files the workers have read"
+        if self.folder is not None:
+            for path in [p for p in self.written if not os.path.exists(p)]:
+                del self.written[path]
+        return sum(self.downloading.values()) + sum(self.written.values())
+
+    def has_room(self, size):
+        used = self.used()
+        return used == 0 or used + size <= self.max_bytes
+
+    def reserve(self, slot, size, wait=True):
+        """Key to store the body of slot with (see store) once size bytes are reserved for it,
+        None when the spool is closed or, unless wait, when it is not the turn of slot or
+        there is no room. The key is the path to write the body to when the spool has a folder"""
+        with self.condition:
+            while not self.closed and not (min(self.waiting) == slot.number and self.has_room(size)):
+                if not wait or slot.number in self.skipped:
+                    return None
+                self.condition.wait(SPOOL_POLL_SECS)
+            if self.closed:
+                return None
+            self.waiting.discard(slot.number)
+            key = slot.number if self.folder is None else os.path.join(self.folder, str(slot.number))
+            self.downloading[key] = size
+            self.condition.notify_all()
+            return key
+
+    def pass_turn(self, slot):
+        with self.condition:
+            self.skipped.discard(slot.number)
+            if slot.number in self.waiting:
+                self.waiting.discard(slot.number)
+                self.condition.notify_all()
+
+    def skip(self, slot):
+        "The download of slot stops waiting for room, reserve returns None unless there is room now"
+        with self.condition:
+            self.skipped.add(slot.number)
+            self.condition.notify_all()
+
+    def written_to(self, key):
+        "The body of key is stored, its room is freed once a worker reads it"
+        with self.condition:
+            self.written[key] = self.downloading.pop(key)
+
+    def store(self, key, fileobj):
+        """Stores the body read from fileobj with the key reserve returned, returns what a
+        payload carries of it: {'path'} of its file or {'path': None, 'body'}, a MemoryBody"""
+        if self.folder is None:
+            body = MemoryBody(self, key, fileobj.read())
+            self.written_to(key)
+            return {'path': None, 'body': body}
+        with open(key, 'wb') as f:
+            shutil.copyfileobj(fileobj, f)
+        self.written_to(key)
+        return {'path': key}
+
+    def release(self, key):
+        "Frees the room of a body that was not stored or that a worker has read"
+        with self.condition:
+            self.downloading.pop(key, None)
+            self.written.pop(key, None)
+            self.condition.notify_all()
+        if self.folder is not None:
+            discard_path(key)
+
+    def close(self):
+        "Wakes the downloads waiting for room, they give up"
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def remove(self):
+        "Deletes the folder of the spool, once no worker reads from it"
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class SpoolSlot:
+    "The turn of one item in a Spool, see fetch_recording"
+
+    def __init__(self, spool, number):
+        self.spool = spool
+        self.number = number
+
+    def reserve(self, size, wait=True):
+        return self.spool.reserve(self, size, wait)
+
+    def pass_turn(self):
+        self.spool.pass_turn(self)
+
+    def skip(self):
+        self.spool.skip(self)
+
+    def written_to(self, key):
+        self.spool.written_to(key)
+
+    def store(self, key, fileobj):
+        return self.spool.store(key, fileobj)
+
+    def release(self, key):
+        self.spool.release(key)
+
+
+class MemoryBody:
+    "A body downloaded ahead for a worker of this process, its room is freed once it is taken"
+
+    def __init__(self, spool, key, data):
+        self.spool = spool
+        self.key = key
+        self.data = data
+
+    def take(self):
+        "The bytes of the body, None once taken"
+        data = self.data
+        if data is not None:
+            self.data = None
+            self.spool.release(self.key)
+        return data
+
+
+def discard_path(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def discard(payload):
+    "Frees the room of the body of a payload of fetch_recording if it was not read"
+    if payload is None:
+        return
+    if payload.get('body') is not None:
+        payload['body'].take()
+    if payload.get('path') is not None:
+        discard_path(payload['path'])
+
+
+def fetch_recording(bucket, uri, slot):
+    """Downloads a recording ahead of Rec into the spool of slot. Returns {'etag', 'size',
+    'path'} and, for a spool in memory, 'body' (see Spool.store). There is no body when the
+    decoded recording is already in the local cache or when it is big enough to be analyzed
+    in streaming mode. Returns None when the download failed (Rec then retries it and
+    reports the error itself). Rec frees the room of the body once it has read it."""
+    s3 = get_client()
+    cache = get_cache()
+    key = None
+    try:
+        extraArgs = {}
+        if cache is not None and cache_config['cache_head']:
+            head = s3.head_object(Bucket=bucket, Key=uri)
+            etag = head['ETag']
+            if cache.contains(bucket, uri, etag):
+                return {'etag': etag, 'size': head['ContentLength'], 'path': None}
+            extraArgs = {'IfMatch': etag}
+        response = s3.get_object(Bucket=bucket, Key=uri, **extraArgs)
+        size = response['ContentLength']
+        etag = response['ETag']
+        if (cache is not None and len(extraArgs) == 0 and cache.contains(bucket, uri, etag)) or is_streamed(size):
+            response['Body'].close()
+            return {'etag': etag, 'size': size, 'path': None}
+        key = slot.reserve(size, wait=False)
+        if key is None:
+            # don't hold the connection while the workers catch up, ask again once there is room
+            response['Body'].close()
+            key = slot.reserve(size)
+            if key is None:
+                # no room by the time the consumer got to it, Rec downloads it itself
+                return {'etag': etag, 'size': size, 'path': None}
+            response = s3.get_object(Bucket=bucket, Key=uri, IfMatch=etag)
+        with contextlib.closing(response['Body']) as body:
+            stored = slot.store(key, body)
+        return dict(stored, etag=etag, size=size)
+    except Exception:
+        if key is not None:
+            slot.release(key)
+        return None
+
+
+def is_streamed(size):
+    "Recordings of at least STREAM_MIN_BYTES are never held in memory whole"
+    return rec_config['stream_min_bytes'] > 0 and size >= rec_config['stream_min_bytes']
+
+
+def fetch_in_turn(fetch, item, slot):
+    try:
+        return fetch(item, slot)
+    finally:
+        # a fetch that never reserved room must not hold back the next items
+        slot.pass_turn()
+
+
+def prefetch(items, fetch, spool, depth=None, threads=None):
+    """Yields (item, fetch(item, slot)) in the order of items while a pool of I/O threads
+    fetches up to `depth` items ahead. fetch stores what it downloads in the Spool spool,
+    reserving room with its SpoolSlot slot, so the bodies downloaded ahead stay bounded
+    until the consumer reads them, even after they are yielded. The consumer never waits
+    for room: an item whose fetch is still waiting for it when the consumer gets to the
+    item is yielded without a body. joblib pulls a whole batch of tasks before it
+    dispatches any, room that only its workers free would never come."""
+    depth = depth or config['prefetch_depth']
+    threads = threads or config['prefetch_threads']
+    items = iter(items)
+    pending = deque()
+    exhausted = False
+    pool = ThreadPoolExecutor(max_workers=threads)
+    try:
+        while True:
+            while not exhausted and len(pending) < depth:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                slot = spool.slot()
+                pending.append((item, slot, pool.submit(fetch_in_turn, fetch, item, slot)))
+            if len(pending) == 0:
+                return
+            item, slot, future = pending.popleft()
+            if not future.done():
+                slot.skip()
+            yield item, future.result()
+    finally:
+        # the consumer stopped early (error or cancellation), drop what is still queued
+        for (_, _, future) in pending:
+            future.cancel()
+        spool.close()
+        pool.shutdown(wait=True)
+        for (_, _, future) in pending:
+            if not future.cancelled() and future.exception() is None:
+                discard(future.result())
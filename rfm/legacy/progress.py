@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+
+from .db import add_job_progress, get_connection
+
+config = {
+    'progress_flush_items': int(os.getenv('PROGRESS_FLUSH_ITEMS', '20')),
+    'progress_flush_secs': float(os.getenv('PROGRESS_FLUSH_SECS', '5')),
+}
+
+
+class ProgressAccumulator:
+    """Adds up job progress increments and writes them with one UPDATE per job once
+    flush_items increments are pending or flush_secs have passed since the last write."""
+
+    def __init__(self, flush_items, flush_secs):
+        self.flush_items = flush_items
+        self.flush_secs = flush_secs
+        self.pending = {}
+        self.count = 0
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, job_id, increment=1):
+        with self.lock:
+            self.pending[job_id] = self.pending.get(job_id, 0) + increment
+            self.count += increment
+            due = self.count >= self.flush_items or time.time() - self.last_flush >= self.flush_secs
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.count = 0
+            self.last_flush = time.time()
+        if len(pending) == 0:
+            return
+        try:
+            db = get_connection()
+            try:
+                for (job_id, increment) in pending.items():
+                    add_job_progress(db, job_id, increment)
+            finally:
+                db.close()
+        except Exception:
+            # progress is advisory, keep the increments for the next write
+            with self.lock:
+                for (job_id, increment) in pending.items():
+                    self.pending[job_id] = self.pending.get(job_id, 0) + increment
+                    self.count += increment
+
+
+_progress = None
+_progress_pid = None
+
+
+def get_progress():
+    "Returns the ProgressAccumulator of the current process"
+    global _progress, _progress_pid
+    if _progress is None or _progress_pid != os.getpid():
+        _progress = ProgressAccumulator(config['progress_flush_items'], config['progress_flush_secs'])
+        _progress_pid = os.getpid()
+    return _progress
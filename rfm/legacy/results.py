@@ -0,0 +1,139 @@
+import csv
+import io
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from .db import insert_classification_results, insert_rec_errors
+from .storage import upload_fileobj
+
+config = {
+    'result_batch_size': int(os.getenv('RESULT_BATCH_SIZE', '500')),
+    'result_upload_threads': int(os.getenv('RESULT_UPLOAD_THREADS', '16')),
+}
+
+
+def vector_csv(featvector):
+    "The feature vector as the one-line CSV stored in the bucket"
+    text = io.StringIO()
+    csv.writer(text).writerow(featvector)
+    return text.getvalue().encode()
+
+
+class ResultSink:
+    """Stores the results of a classification job in bulk. Result rows and recording errors
+    are buffered and written with one multi-row INSERT per batch_size rows, vectors are
+    uploaded from memory by upload_threads threads with at most 2*upload_threads uploads
+    pending. Use as a context manager, everything is written when it exits. The database
+    is only used from the thread that adds the results. checkpoint, when given, is called
+    with each batch of result rows before it is written. Failed writes are reported to the
+    job log, when given. close(discard=True) drops what is not written yet, for a canceled
+    job."""
+
+    def __init__(self, db, job_id, species, songtype, batch_size=None, upload_threads=None, checkpoint=None, log=None):
+        self.db = db
+        self.job_id = job_id
+        self.species = species
+        self.songtype = songtype
+        self.checkpoint = checkpoint
+        self.log = log
+        self.batch_size = batch_size or config['result_batch_size']
+        upload_threads = upload_threads or config['result_upload_threads']
+        if self.batch_size < 1 or upload_threads < 1:
+            raise ValueError("batch_size and upload_threads must be positive")
+        self.results = []
+        self.errors = []
+        self.lock = threading.Lock()
+        self.uploads = ThreadPoolExecutor(max_workers=upload_threads)
+        self.slots = threading.BoundedSemaphore(2 * upload_threads)
+        self.discarding = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def add_result(self, rec_id, presence, max_v):
+        self.results.append((self.job_id, rec_id, self.species, self.songtype, presence, float(max_v)))
+        if len(self.results) >= self.batch_size:
+            self.flush_results()
+        if len(self.errors) >= self.batch_size:
+            self.flush_errors()
+
+    def add_error(self, rec_id, error=None):
+        "Records an error of rec_id, by default the exception being handled"
+        self.buffer_error(rec_id, error)
+        if len(self.errors) >= self.batch_size:
+            self.flush_errors()
+
+    def buffer_error(self, rec_id, error=None):
+        if error is None:
+            error = traceback.format_exc()
+        with self.lock:
+            self.errors.append((rec_id, self.job_id, error))
+
+    def upload_vector(self, key, featvector, rec_id):
+        # blocks while too many uploads are pending, so the vectors in memory stay bounded
+        self.slots.acquire()
+        try:
+            self.uploads.submit(self.upload, key, vector_csv(featvector), rec_id)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def upload(self, key, body, rec_id):
+        try:
+            if self.discarding:
+                return
+            upload_fileobj(io.BytesIO(body), key)
+        except Exception:
+            # written by the thread of the sink
+            self.buffer_error(rec_id)
+        finally:
+            self.slots.release()
+
+    def flush_results(self):
+        rows = self.results
+        self.results = []
+        if len(rows) == 0:
+            return
+        if self.checkpoint is not None:
+            self.checkpoint(rows)
+        # the connection may have idled for a long time between two batches
+        self.db.ping(reconnect=True)
+        try:
+            insert_classification_results(self.db, rows)
+        except Exception:
+            if self.log is not None:
+                self.log.write('ERROR writing results of job #{}, retrying row by row {}'.format(self.job_id, traceback.format_exc()))
+            self.db.rollback()
+            # find the rows that fail, the others are still stored
+            for row in rows:
+                try:
+                    insert_classification_results(self.db, [row])
+                except Exception:
+                    self.db.rollback()
+                    self.buffer_error(row[1])
+
+    def flush_errors(self):
+        with self.lock:
+            rows = self.errors
+            self.errors = []
+        if len(rows) > 0:
+            self.db.ping(reconnect=True)
+            insert_rec_errors(self.db, rows)
+
+    def close(self, discard=False):
+        if discard:
+            # the uploads not started yet are skipped, the rows buffered are not written
+            self.discarding = True
+            self.uploads.shutdown(wait=True)
+            self.results = []
+            with self.lock:
+                self.errors = []
+            return
+        self.uploads.shutdown(wait=True)
+        self.flush_results()
+        self.flush_errors()
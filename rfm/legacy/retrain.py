@@ -14,7 +14,8 @@ import time
 
 from .a2audio.model import Model
 from .a2audio.roiset import Roiset
-from .a2audio.training import recnilize, roigen
+from .a2audio.template import CompiledTemplate
+from .a2audio.training import group_by_recording, in_line_order, recnilize, roigen_recording
 from .a2pyutils.logger import Logger
 from .db import connect, get_training_job, get_training_job_params, get_training_data, get_validation_data, update_job_error, update_job_last_update, update_job_progress, update_validations, get_retraining_job, set_progress_steps
 from .storage import upload_file, download_file, rename_file
@@ -23,7 +24,7 @@ num_cores = multiprocessing.cpu_count()
 
 def exit_error(db, log, job_id, msg):
     log.write(msg)
-    update_job_error(db, msg, job_id)
+    update_job_error(db, job_id, msg)
     remove_working_folder(job_id)
     sys.exit(-1)
 
@@ -137,8 +138,11 @@ def retrain(job_id: int):
     
     """Roigenerator"""
     try:
-        # roigen defined in a2audio.training
-        rois = Parallel(n_jobs=num_cores)(delayed(roigen)(line,working_folder,job_id,log) for line in training_data)
+        # roigen_recording defined in a2audio.training
+        # a task per recording, that fetches it once for all its rois
+        groups = group_by_recording(training_data)
+        rois = Parallel(n_jobs=num_cores)(delayed(roigen_recording)([training_data[k] for k in group],working_folder,job_id,log) for group in groups)
+        rois = in_line_order(groups, rois, len(training_data))
     except Exception:
         exit_error(db, log, job_id, 'roigenerator failed. {}'.format(traceback.format_exc()))
 
@@ -158,8 +162,9 @@ def retrain(job_id: int):
                 lowFreq = roi[0].lowF
                 highFreq = roi[0].highF
                 sample_rate = roi[0].sample_rate
+                # the band of the roi, rows specRow:(specRow+len(spec)) of specRows
                 spec = roi[0].spec
-                rows = spec.shape[0]
+                rows = roi[0].specRows
                 columns = spec.shape[1]
                 if classid in classes:
                     classes[classid].addRoi(
@@ -168,7 +173,8 @@ def retrain(job_id: int):
                         float(sample_rate),
                         spec,
                         rows,
-                        columns
+                        columns,
+                        roi[0].specRow
                     )
                 else:
                     classes[classid] = Roiset(classid, float(sample_rate))
@@ -178,7 +184,8 @@ def retrain(job_id: int):
                         float(sample_rate),
                         spec,
                         rows,
-                        columns
+                        columns,
+                        roi[0].specRow
                     )
 
         for i in classes:
@@ -188,7 +195,9 @@ def retrain(job_id: int):
                 classes[i].setSampleRate,
                 classes[i].lowestFreq,
                 classes[i].highestFreq,
-                classes[i].maxColumns
+                classes[i].maxColumns,
+                CompiledTemplate(classes[i].getSurface()).precompile(
+                    classes[i].lowestFreq, classes[i].highestFreq, {int(classes[i].setSampleRate), 44100})
             ]
             models[i] = Model(i,pattern_surfaces[i][0],job_id)
     except Exception:
@@ -1,6 +1,7 @@
-import boto3
 import os
 
+from .storage_client import get_client
+
 config = {
     's3_access_key_id': os.getenv('AWS_ACCESS_KEY_ID'),
     's3_secret_access_key': os.getenv('AWS_SECRET_ACCESS_KEY'),
@@ -10,19 +11,17 @@ config = {
 }
 
 def upload_file(local_path, key):
-    s3 = boto3.resource('s3', aws_access_key_id=config['s3_access_key_id'], 
-                        aws_secret_access_key=config['s3_secret_access_key'], endpoint_url=config['s3_endpoint'])
-    bucket = s3.Bucket(config['s3_legacy_bucket_name'])
-    bucket.upload_file(local_path, key, ExtraArgs={'ACL': 'public-read'})
+    get_client().upload_file(local_path, config['s3_legacy_bucket_name'], key, ExtraArgs={'ACL': 'public-read'})
 
 def download_file(key, local_path):
-    s3 = boto3.resource('s3', aws_access_key_id=config['s3_access_key_id'], 
-                        aws_secret_access_key=config['s3_secret_access_key'], endpoint_url=config['s3_endpoint'])
-    bucket = s3.Bucket(config['s3_legacy_bucket_name'])
-    bucket.download_file(key, local_path)
+    get_client().download_file(config['s3_legacy_bucket_name'], key, local_path)
     
 def rename_file(key, new_key):
-    s3 = boto3.resource('s3', aws_access_key_id=config['s3_access_key_id'], 
-                        aws_secret_access_key=config['s3_secret_access_key'], endpoint_url=config['s3_endpoint'])
-    bucket = s3.Bucket(config['s3_legacy_bucket_name'])
-    bucket.Object(new_key).copy_from(CopySource={'Bucket': config['s3_legacy_bucket_name'], 'Key': key}, ACL='public-read')
+    get_client().copy_object(Bucket=config['s3_legacy_bucket_name'], Key=new_key,
+                             CopySource={'Bucket': config['s3_legacy_bucket_name'], 'Key': key}, ACL='public-read')
+
+def upload_fileobj(fileobj, key):
+    get_client().upload_fileobj(fileobj, config['s3_legacy_bucket_name'], key, ExtraArgs={'ACL': 'public-read'})
+
+def read_file(key):
+    return get_client().get_object(Bucket=config['s3_legacy_bucket_name'], Key=key)['Body'].read()
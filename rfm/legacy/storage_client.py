@@ -0,0 +1,94 @@
+import io
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+config = {
+    's3_access_key_id': os.getenv('AWS_ACCESS_KEY_ID'),
+    's3_secret_access_key': os.getenv('AWS_SECRET_ACCESS_KEY'),
+    's3_endpoint': os.getenv('S3_ENDPOINT'),
+    's3_max_pool_connections': int(os.getenv('S3_MAX_POOL_CONNECTIONS', '32')),
+}
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def create_client():
+    session = boto3.session.Session(
+        aws_access_key_id=config['s3_access_key_id'],
+        aws_secret_access_key=config['s3_secret_access_key'])
+    return session.client(
+        's3',
+        endpoint_url=config['s3_endpoint'],
+        config=Config(
+            max_pool_connections=config['s3_max_pool_connections'],
+            tcp_keepalive=True,
+            retries={'max_attempts': 5, 'mode': 'standard'}))
+
+
+def get_client():
+    """Returns the S3 client of the current process. It is created once per process
+    (credentials, session and connection pool included) and is safe to share between threads."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = create_client()
+                _client_pid = pid
+    return _client
+
+
+class S3RangeFile:
+    """Read-only, seekable file object over an S3 object that fetches byte ranges
+    on demand. Reads smaller than block_size are served from one read-ahead block,
+    so parsing a header or seeking costs a single ranged GET. The object is only asked
+    for its size and etag when they are not given."""
+
+    def __init__(self, bucket, key, block_size=256 * 1024, size=None, etag=None):
+        self.client = get_client()
+        self.bucket = bucket
+        self.key = key
+        self.block_size = block_size
+        if size is None or etag is None:
+            head = self.client.head_object(Bucket=bucket, Key=key)
+            size = head['ContentLength']
+            etag = head['ETag']
+        self.size = size
+        self.etag = etag
+        self.position = 0
+        self.block_start = 0
+        self.block = b''
+        self.requests = 0
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset = self.position + offset
+        elif whence == io.SEEK_END:
+            offset = self.size + offset
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        end = min(self.size, self.position + size)
+        if end <= self.position:
+            return b''
+        if self.position < self.block_start or end > self.block_start + len(self.block):
+            fetch_end = min(self.size, max(end, self.position + self.block_size))
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self.key, IfMatch=self.etag,
+                Range='bytes={}-{}'.format(self.position, fetch_end - 1))
+            self.block = response['Body'].read()
+            self.block_start = self.position
+            self.requests += 1
+        data = self.block[(self.position - self.block_start):(end - self.block_start)]
+        self.position += len(data)
+        return data
@@ -13,7 +13,8 @@ from pylab import *
 
 from .a2audio.model import Model
 from .a2audio.roiset import Roiset
-from .a2audio.training import recnilize, roigen
+from .a2audio.template import CompiledTemplate
+from .a2audio.training import group_by_recording, in_line_order, preflight, recnilize_recording, roigen_recording
 from .a2pyutils.logger import Logger
 from .db import connect, get_training_job, get_training_job_params, get_training_data, get_validation_data, update_job_error, update_job_last_update, update_job_progress, update_validations
 from .storage import upload_file
@@ -22,7 +23,7 @@ num_cores = multiprocessing.cpu_count()
 
 def exit_error(db, log, job_id, msg):
     log.write(msg)
-    update_job_error(db, msg, job_id)
+    update_job_error(db, job_id, msg)
     remove_working_folder(job_id)
     sys.exit(-1)
 
@@ -128,8 +129,11 @@ def run_train(job_id: int):
     
     """Roigenerator"""
     try:
-        # roigen defined in a2audio.training
-        rois = Parallel(n_jobs=num_cores)(delayed(roigen)(line,working_folder,job_id,log) for line in training_data)
+        # roigen_recording defined in a2audio.training
+        # a task per recording, that fetches it once for all its rois
+        groups = group_by_recording(training_data)
+        rois = Parallel(n_jobs=num_cores)(delayed(roigen_recording)([training_data[k] for k in group],working_folder,job_id,log) for group in groups)
+        rois = in_line_order(groups, rois, len(training_data))
     except Exception:
         exit_error(db, log, job_id, 'roigenerator failed. {}'.format(traceback.format_exc()))
 
@@ -148,8 +152,9 @@ def run_train(job_id: int):
                 lowFreq = roi[0].lowF
                 highFreq = roi[0].highF
                 sample_rate = roi[0].sample_rate
+                # the band of the roi, rows specRow:(specRow+len(spec)) of specRows
                 spec = roi[0].spec
-                rows = spec.shape[0]
+                rows = roi[0].specRows
                 columns = spec.shape[1]
                 if classid in classes:
                     classes[classid].addRoi(
@@ -158,7 +163,8 @@ def run_train(job_id: int):
                         float(sample_rate),
                         spec,
                         rows,
-                        columns
+                        columns,
+                        roi[0].specRow
                     )
                 else:
                     classes[classid] = Roiset(classid, float(sample_rate))
@@ -168,7 +174,8 @@ def run_train(job_id: int):
                         float(sample_rate),
                         spec,
                         rows,
-                        columns
+                        columns,
+                        roi[0].specRow
                     )
 
         for i in classes:
@@ -178,7 +185,9 @@ def run_train(job_id: int):
                 classes[i].setSampleRate,
                 classes[i].lowestFreq,
                 classes[i].highestFreq,
-                classes[i].maxColumns
+                classes[i].maxColumns,
+                CompiledTemplate(classes[i].getSurface()).precompile(
+                    classes[i].lowestFreq, classes[i].highestFreq, {int(classes[i].setSampleRate), 44100})
             ]
     except Exception:
         exit_error(db, log, job_id, 'cannot align rois. {}'.format(traceback.format_exc()))
@@ -189,7 +198,13 @@ def run_train(job_id: int):
 
     """Recnilize"""
     try:
-        results = Parallel(n_jobs=num_cores)(delayed(recnilize)(line,working_folder,job_id,(pattern_surfaces[line[4]]),log,True,False) for line in validation_data)
+        lines, results = preflight(validation_data, pattern_surfaces, job_id, log)
+        # a task per recording, that matches it against the patterns of all its lines
+        groups = group_by_recording(lines)
+        grouped = Parallel(n_jobs=num_cores)(delayed(recnilize_recording)(
+            [lines[k] for k in group],working_folder,job_id,{lines[k][4]: pattern_surfaces[lines[k][4]] for k in group},log,True,False)
+            for group in groups)
+        results = results + in_line_order(groups, grouped, len(lines))
     except Exception:
         exit_error(db, log, job_id, 'cannot analyze recordings in parallel {}'.format(traceback.format_exc()))
     log.write('validation recordings analyzed')
@@ -0,0 +1,64 @@
+import numpy
+import pytest
+
+from rfm.legacy.a2audio.alignment import OffsetSearch
+
+
+def best_offset_loop(reference, spec, first, offsets):
+    "The loop Roiset.alignSamples ran before OffsetSearch"
+    rows, columns = spec.shape
+    distances = []
+    for j in range(offsets):
+        distances.append(numpy.linalg.norm(reference[first:(first + rows), j:(j + columns)] - spec))
+    if len(distances) > 0:
+        return distances.index(min(distances))
+    return 0
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_matches_the_norm_loop(seed):
+    rng = numpy.random.RandomState(seed)
+    rows = rng.randint(1, 30)
+    width = rng.randint(2, 200)
+    reference = rng.uniform(-100, 0, size=(rows, width))
+    if seed % 3 == 0:
+        # rois are zero outside their band and columns, whole windows of zeros tie
+        reference[:, rng.randint(0, width):] = 0
+    if seed % 5 == 0:
+        # repeated columns make exact ties between offsets
+        reference = numpy.round(reference / 50) * 50
+    band_rows = rng.randint(1, rows + 1)
+    first = rng.randint(0, rows - band_rows + 1)
+    columns = rng.randint(1, width)
+    spec = rng.uniform(-100, 0, size=(band_rows, columns))
+    if seed % 7 == 0:
+        spec = numpy.round(spec / 50) * 50
+    offsets = width - columns
+    search = OffsetSearch(reference)
+    assert search.best_offset(spec, first, offsets) == best_offset_loop(reference, spec, first, offsets)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_ties_go_to_the_first_offset(seed):
+    rng = numpy.random.RandomState(seed)
+    # a periodic reference, the roi fits exactly once per period
+    period = rng.randint(1, 20)
+    rows = rng.randint(1, 20)
+    reference = numpy.tile(rng.uniform(-100, 0, size=(rows, period)), 12)
+    columns = rng.randint(1, 3 * period + 1)
+    start = rng.randint(0, period)
+    spec = reference[:, start:(start + columns)].copy()
+    offsets = reference.shape[1] - columns
+    search = OffsetSearch(reference)
+    assert search.best_offset(spec, 0, offsets) == best_offset_loop(reference, spec, 0, offsets) == start
+
+
+def test_a_copied_window_is_found():
+    rng = numpy.random.RandomState(1)
+    reference = rng.uniform(-100, 0, size=(20, 300))
+    spec = reference[5:12, 140:180].copy()
+    assert OffsetSearch(reference).best_offset(spec, 5, 260) == 140
+
+
+def test_no_offsets():
+    assert OffsetSearch(numpy.zeros((3, 10))).best_offset(numpy.zeros((3, 10)), 0, 0) == 0
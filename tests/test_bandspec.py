@@ -0,0 +1,43 @@
+import numpy
+import pytest
+from matplotlib import mlab
+
+from rfm.legacy.a2audio.bandspec import band_rows, psd_band, psd_band_blocks, psd_freqs
+
+
+def signal(length, seed=0):
+    rng = numpy.random.RandomState(seed)
+    t = numpy.arange(length) / 44100.0
+    return numpy.sin(2 * numpy.pi * 3000 * t) + 0.5 * rng.normal(size=length)
+
+
+# Recanalizer's spectrograms use a window of 2*nfft and a hop of nfft
+@pytest.mark.parametrize('nfft', [512, 342, 300])
+# a narrow band takes the band-only DFT, the others a FFT per column
+@pytest.mark.parametrize('band', [(2900.0, 3100.0), (2000.0, 4000.0), (100.0, 21000.0), (0.0, 22050.0)])
+def test_psd_band_rows_of_specgram(nfft, band):
+    data = signal(44100)
+    Pxx, freqs, bins = mlab.specgram(data, NFFT=nfft * 2, Fs=44100, noverlap=nfft)
+    numpy.testing.assert_array_equal(psd_freqs(nfft * 2, 44100), freqs)
+    first, last = band_rows(freqs, *band)
+    last = min(last + 1, len(freqs))
+    numpy.testing.assert_allclose(psd_band(data, 44100, nfft * 2, nfft, first, last), Pxx[first:last],
+                                  rtol=1e-9, atol=1e-20)
+
+
+@pytest.mark.filterwarnings('ignore:Only one segment')
+@pytest.mark.parametrize('nfft', [512, 342, 300])
+def test_psd_band_of_a_signal_shorter_than_the_window(nfft):
+    data = signal(nfft + 10)
+    Pxx, freqs, bins = mlab.specgram(data, NFFT=nfft * 2, Fs=44100, noverlap=nfft)
+    numpy.testing.assert_allclose(psd_band(data, 44100, nfft * 2, nfft, 10, 40), Pxx[10:40], rtol=1e-9, atol=1e-20)
+
+
+@pytest.mark.parametrize('nfft', [512, 342, 300])
+@pytest.mark.parametrize('block_size', [100, 1000, 4096, 100000])
+def test_psd_band_blocks_equal_psd_band(nfft, block_size):
+    data = signal(123457, seed=nfft)
+    blocks = (data[b:(b + block_size)] for b in range(0, len(data), block_size))
+    chunks = list(psd_band_blocks(blocks, 44100, nfft * 2, nfft, 20, 60))
+    whole = psd_band(data, 44100, nfft * 2, nfft, 20, 60)
+    numpy.testing.assert_allclose(numpy.concatenate(chunks, axis=1), whole, rtol=1e-12, atol=0)
@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+import rfm.legacy.cancel as cancel
+from rfm.legacy.cancel import CancelWatcher, cancel_flag, is_canceled
+
+
+class FakeConnection:
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def jobs(monkeypatch, tmp_path):
+    "Cancel requests of the fake database, and the jobs it marked canceled"
+    jobs = {'requested': set(), 'marked': [], 'polled': threading.Event()}
+
+    def get_canceled_jobs(db, job_ids):
+        jobs['polled'].set()
+        return set(job_ids) & jobs['requested']
+
+    monkeypatch.setattr(cancel.tempfile, 'gettempdir', lambda: str(tmp_path))
+    monkeypatch.setattr(cancel, 'get_connection', FakeConnection)
+    monkeypatch.setattr(cancel, 'get_canceled_jobs', get_canceled_jobs)
+    monkeypatch.setattr(cancel, 'set_job_canceled', lambda db, job_id: jobs['marked'].append(job_id))
+    return jobs
+
+
+def test_poll_flags_the_canceled_jobs(jobs):
+    watcher = CancelWatcher([1, 2])
+    watcher.poll()
+    assert not is_canceled(1) and not is_canceled(2)
+    jobs['requested'].add(2)
+    watcher.poll()
+    watcher.poll()
+    assert is_canceled(2) and not is_canceled(1)
+    # marked once, however many polls see it
+    assert jobs['marked'] == [2]
+    assert watcher.canceled == {2}
+    assert not watcher.all_canceled()
+
+
+def test_dispatching_stops_once_every_job_is_canceled(jobs):
+    watcher = CancelWatcher([1, 2])
+    dispatched = []
+    for item in watcher.until_canceled(iter(range(10))):
+        dispatched.append(item)
+        if item == 2:
+            watcher.cancel(1)
+        if item == 4:
+            jobs['requested'].add(2)
+            watcher.poll()
+    assert dispatched == [0, 1, 2, 3, 4]
+    assert watcher.all_canceled()
+
+
+def test_the_source_is_closed_when_dispatching_stops(jobs):
+    closed = []
+
+    def source():
+        try:
+            for k in range(10):
+                yield k
+        finally:
+            closed.append(True)
+
+    watcher = CancelWatcher([1])
+    watcher.cancel(1)
+    assert list(watcher.until_canceled(source())) == []
+    assert closed == [True]
+
+
+def test_the_thread_polls_and_stops_with_the_context(jobs):
+    jobs['requested'].add(3)
+    with CancelWatcher([3], interval=0.01) as watcher:
+        assert jobs['polled'].wait(5)
+        thread = watcher.thread
+    assert not thread.is_alive()
+    assert watcher.canceled == {3}
+    # the flags don't outlive the run
+    assert not is_canceled(3)
+
+
+def test_flags_of_an_earlier_run_are_removed(jobs):
+    open(cancel_flag(4), 'w').close()
+    assert is_canceled(4)
+    CancelWatcher([4])
+    assert not is_canceled(4)
@@ -0,0 +1,137 @@
+from collections import deque
+
+import pytest
+
+import rfm.legacy.classify as classify
+import rfm.legacy.results as results
+from rfm.legacy.classify import JobResults, classify_rec_model, complete_job, store_rejected
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, query, params=None):
+        self.db.queries.append(query)
+
+    def fetchone(self):
+        # cancel_requested of the job
+        return (self.db.cancel_requested,)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, cancel_requested=0):
+        self.cancel_requested = cancel_requested
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def ping(self, reconnect=False):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeLog:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, message):
+        self.lines.append(message)
+
+
+class FakeProgress:
+    def __init__(self):
+        self.steps = {}
+
+    def add(self, job_id, increment=1):
+        self.steps[job_id] = self.steps.get(job_id, 0) + increment
+
+    def flush(self):
+        pass
+
+
+@pytest.fixture
+def progress(monkeypatch):
+    progress = FakeProgress()
+    monkeypatch.setattr(classify, 'get_progress', lambda: progress)
+    return progress
+
+
+def model_specs(job_id=9):
+    return {'job_id': job_id, 'working_folder': '/tmp/', 'data': [None, None, 1000.0, 2000.0],
+            'template': None, 'sample_rate': 44100, 'species': 'sp', 'songtype': 'st', 'uri': 'models/m.mod'}
+
+
+REC = {'recording_id': 5, 'uri': 'recs/a.flac', 'legacy': 0}
+
+
+def fake_recanalizer(status):
+    class FakeRecanalizer:
+        def __init__(self, *args, **kwargs):
+            self.status = status
+
+        def getVector(self):
+            return [0.1, 0.2]
+
+        def features(self):
+            return [1.0]
+
+    return FakeRecanalizer
+
+
+def test_an_unprocessed_recording_stores_its_status(progress, monkeypatch):
+    monkeypatch.setattr(classify, 'Recanalizer', fake_recanalizer('AudioIsShort'))
+    assert classify_rec_model(REC, None, model_specs(), FakeLog()) == {'id': 5, 'err': 'AudioIsShort'}
+
+
+def test_a_failed_analysis_stores_its_traceback(progress, monkeypatch):
+    def failing(*args, **kwargs):
+        raise RuntimeError('decoder exploded')
+
+    monkeypatch.setattr(classify, 'Recanalizer', failing)
+    result = classify_rec_model(REC, None, model_specs(), FakeLog())
+    assert result['id'] == 5
+    assert 'RuntimeError: decoder exploded' in result['err']
+
+
+def test_a_processed_recording_returns_its_features(progress, monkeypatch):
+    monkeypatch.setattr(classify, 'Recanalizer', fake_recanalizer('Processed'))
+    result = classify_rec_model(REC, None, model_specs(), FakeLog())
+    assert result == {'uri': 'recs/a.flac', 'id': 5, 'f': [0.1, 0.2], 'ft': [1.0]}
+    assert progress.steps == {9: 1}
+
+
+def test_a_rejected_recording_takes_both_its_progress_steps(progress, monkeypatch):
+    monkeypatch.setattr(classify, 'connect', FakeConnection)
+    streams = [JobResults(model_specs(9), 1, FakeLog()), JobResults(model_specs(10), 1, FakeLog())]
+    rejected = deque([(9, 5, 'CannotProcess (sample rate 8000, duration 60)'), (10, 6, 'AudioIsShort')])
+    store_rejected(streams, rejected, canceled={10})
+    assert len(rejected) == 0
+    assert progress.steps == {9: 2}
+    assert streams[0].pending == [{'id': 5, 'err': 'CannotProcess (sample rate 8000, duration 60)'}]
+    assert streams[1].pending == []
+
+
+def test_a_canceled_job_writes_no_more_results(progress, monkeypatch, tmp_path):
+    writes = []
+    monkeypatch.setattr(classify, 'connect', lambda: FakeConnection(cancel_requested=1))
+    monkeypatch.setattr(classify, 'upload_fileobj', lambda fileobj, key: writes.append(('checkpoint', key)))
+    monkeypatch.setattr(results, 'insert_classification_results', lambda db, rows: writes.append(('results', rows)))
+    monkeypatch.setattr(results, 'insert_rec_errors', lambda db, rows: writes.append(('errors', rows)))
+    monkeypatch.setattr(results, 'upload_fileobj', lambda fileobj, key: writes.append(('vector', key)))
+    specs = dict(model_specs(9), working_folder=str(tmp_path) + '/')
+    stream = JobResults(specs, 1, FakeLog())
+    stream.add({'uri': 'recs/a.flac', 'id': 5, 'f': [0.1, 0.2], 'ft': [1.0]})
+    stream.add({'id': 6, 'err': 'AudioIsShort'})
+    assert complete_job(stream, FakeLog(), standalone=False, canceled=True) is False
+    assert writes == []
+    assert stream.pending == []
@@ -0,0 +1,160 @@
+import io
+import os
+import threading
+import time
+
+import rfm.legacy.prefetch as prefetch_module
+from rfm.legacy.prefetch import Spool, discard, open_spool, prefetch
+
+
+def spooled_bytes(folder):
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+
+
+def write_bodies(sizes, peaks, folder):
+    "A fetch writing a body of sizes[item] bytes to the spool, recording the bytes in the folder"
+    def fetch(item, slot):
+        size = sizes[item]
+        path = slot.reserve(size)
+        if path is None:
+            return {'etag': None, 'size': size, 'path': None}
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        slot.written_to(path)
+        peaks.append(spooled_bytes(folder))
+        return {'etag': None, 'size': size, 'path': path}
+    return fetch
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_the_consumer_never_waits_for_room(tmp_path):
+    folder = str(tmp_path)
+    peaks = []
+    spool = Spool(folder, max_bytes=100)
+    tasks = prefetch(range(6), write_bodies([40] * 6, peaks, folder), spool, depth=6, threads=6)
+    # joblib takes a batch of tasks before it dispatches any of them
+    batch = [next(tasks) for k in range(4)]
+    # two bodies fit, the others are left to the workers
+    assert [payload['path'] is not None for (item, payload) in batch] == [True, True, False, False]
+    assert spooled_bytes(folder) == 80
+    for (item, payload) in batch:
+        discard(payload)
+    rest = list(tasks)
+    assert [item for (item, payload) in batch + rest] == list(range(6))
+    assert [payload['path'] is not None for (item, payload) in rest] == [True, True]
+    for (item, payload) in rest:
+        discard(payload)
+    assert max(peaks) <= 100
+    assert spooled_bytes(folder) == 0
+
+
+def test_yielded_bodies_count_until_read(tmp_path):
+    folder = str(tmp_path)
+    peaks = []
+    spool = Spool(folder, max_bytes=100)
+    for item, payload in prefetch(range(6), write_bodies([40] * 6, peaks, folder), spool, depth=6, threads=6):
+        # read before the next item is asked for, room was made for every body
+        assert payload['path'] is not None
+        assert spooled_bytes(folder) <= 100
+        discard(payload)
+    assert max(peaks) <= 100
+    assert spooled_bytes(folder) == 0
+
+
+def test_bound_holds_with_parallel_readers(tmp_path):
+    folder = str(tmp_path)
+    peaks = []
+    spool = Spool(folder, max_bytes=1000)
+    sizes = [100, 300, 50, 400, 250, 200, 150, 350] * 3
+    readers = []
+    items = []
+    for item, payload in prefetch(range(len(sizes)), write_bodies(sizes, peaks, folder), spool, depth=8, threads=4):
+        items.append(item)
+        # the worker reads the body a little later, in another thread
+        reader = threading.Timer(0.02, discard, [payload])
+        reader.start()
+        readers.append(reader)
+    for reader in readers:
+        reader.join()
+    assert items == list(range(len(sizes)))
+    assert max(peaks) <= 1000
+
+
+def test_a_body_bigger_than_the_bound_goes_through_alone(tmp_path):
+    folder = str(tmp_path)
+    peaks = []
+    spool = Spool(folder, max_bytes=10)
+    for item, payload in prefetch(range(3), write_bodies([30] * 3, peaks, folder), spool, depth=3, threads=3):
+        assert payload['size'] == 30
+        discard(payload)
+    assert peaks == [30, 30, 30]
+
+
+def test_stopping_early_deletes_the_bodies_not_yielded(tmp_path):
+    folder = str(tmp_path)
+    spool = Spool(folder, max_bytes=100)
+    tasks = prefetch(range(10), write_bodies([20] * 10, [], folder), spool, depth=4, threads=4)
+    item, payload = next(tasks)
+    tasks.close()
+    discard(payload)
+    assert spooled_bytes(folder) == 0
+
+
+def store_bodies(sizes, peaks, spool):
+    "A fetch storing a body of sizes[item] bytes in a spool in memory, recording the bytes it holds"
+    def fetch(item, slot):
+        size = sizes[item]
+        key = slot.reserve(size)
+        if key is None:
+            return {'etag': None, 'size': size, 'path': None}
+        stored = slot.store(key, io.BytesIO(b'x' * size))
+        with spool.condition:
+            peaks.append(spool.used())
+        return dict(stored, etag=None, size=size)
+    return fetch
+
+
+def test_bodies_in_memory_count_until_taken():
+    peaks = []
+    spool = Spool(None, max_bytes=100)
+    tasks = prefetch(range(6), store_bodies([40] * 6, peaks, spool), spool, depth=6, threads=6)
+    batch = [next(tasks) for k in range(3)]
+    assert [payload.get('body') is not None for (item, payload) in batch] == [True, True, False]
+    assert batch[0][1]['path'] is None
+    assert batch[0][1]['body'].take() == b'x' * 40
+    # taken once, then its room is free
+    assert batch[0][1]['body'].take() is None
+    discard(batch[1][1])
+    for item, payload in tasks:
+        assert payload['body'].take() == b'x' * 40
+    assert max(peaks) <= 100
+    with spool.condition:
+        assert spool.used() == 0
+
+
+def test_the_spool_of_workers_in_this_process_is_in_memory(tmp_path):
+    assert open_spool(str(tmp_path) + '/', in_process=True).folder is None
+
+
+def test_the_spool_of_other_processes_is_in_shared_memory(tmp_path, monkeypatch):
+    shm = tmp_path / 'shm'
+    shm.mkdir()
+    monkeypatch.setattr(prefetch_module, 'SHM_FOLDER', str(shm))
+    spool = open_spool(str(tmp_path) + '/job/', max_bytes=100)
+    assert os.path.dirname(spool.folder.rstrip('/')) == str(shm)
+    assert spool.max_bytes == 100
+    spool.remove()
+    assert os.listdir(str(shm)) == []
+
+
+def test_the_job_folder_without_shared_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(prefetch_module, 'SHM_FOLDER', str(tmp_path / 'missing'))
+    spool = open_spool(str(tmp_path) + '/job/', max_bytes=100)
+    assert spool.folder == str(tmp_path) + '/job/prefetch/'
+    assert os.path.isdir(spool.folder)
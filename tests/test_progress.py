@@ -0,0 +1,66 @@
+import pytest
+
+import rfm.legacy.progress as progress
+from rfm.legacy.progress import ProgressAccumulator
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    "The (job_id, increment) UPDATEs the accumulator runs"
+    writes = []
+    monkeypatch.setattr(progress, 'get_connection', FakeConnection)
+    monkeypatch.setattr(progress, 'add_job_progress', lambda db, job_id, increment: writes.append((job_id, increment)))
+    return writes
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(progress.time, 'time', lambda: now[0])
+    return now
+
+
+def test_flush_after_flush_items(writes, clock):
+    acc = ProgressAccumulator(20, 5)
+    for k in range(19):
+        acc.add(1 if k % 2 else 2)
+    assert writes == []
+    acc.add(2)
+    assert sorted(writes) == [(1, 9), (2, 11)]
+    # the count starts over after a write
+    acc.add(1)
+    assert len(writes) == 2
+
+
+def test_flush_after_flush_secs(writes, clock):
+    acc = ProgressAccumulator(20, 5)
+    acc.add(1)
+    clock[0] += 4.9
+    acc.add(1)
+    assert writes == []
+    clock[0] += 0.1
+    acc.add(1, 3)
+    assert writes == [(1, 5)]
+
+
+def test_failed_write_keeps_the_increments(writes, clock, monkeypatch):
+    acc = ProgressAccumulator(2, 5)
+
+    def unavailable():
+        raise RuntimeError('database unavailable')
+
+    monkeypatch.setattr(progress, 'get_connection', unavailable)
+    acc.add(7)
+    acc.add(7)
+    assert writes == []
+    monkeypatch.setattr(progress, 'get_connection', FakeConnection)
+    acc.flush()
+    assert writes == [(7, 2)]
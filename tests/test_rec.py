@@ -0,0 +1,115 @@
+import io
+
+import numpy
+import pytest
+import soundfile
+
+import rfm.legacy.a2audio.rec as rec
+import rfm.legacy.a2audio.reccache as reccache
+from rfm.legacy.a2audio.rec import Rec
+from rfm.legacy.a2audio.reccache import RecCache
+from rfm.legacy.prefetch import Spool
+
+
+class FakeBody(io.BytesIO):
+    def __init__(self, data, requests):
+        super().__init__(data)
+        self.requests = requests
+
+    def read(self, *args):
+        self.requests.append('read')
+        return super().read(*args)
+
+    def close(self):
+        self.requests.append('close')
+        super().close()
+
+
+class FakeS3:
+    "One recording in one bucket, the requests made for it"
+
+    def __init__(self, data, etag='"v1"'):
+        self.data = data
+        self.etag = etag
+        self.requests = []
+
+    def head_object(self, Bucket, Key):
+        self.requests.append('head')
+        return {'ETag': self.etag, 'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, IfMatch=None):
+        self.requests.append('get')
+        if IfMatch is not None and IfMatch != self.etag:
+            raise RuntimeError('PreconditionFailed')
+        return {'ETag': self.etag, 'ContentLength': len(self.data), 'Body': FakeBody(self.data, self.requests)}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    samples = numpy.random.RandomState(0).uniform(-0.5, 0.5, 8000)
+    data = io.BytesIO()
+    soundfile.write(data, samples, 16000, format='WAV', subtype='PCM_16')
+    s3 = FakeS3(data.getvalue())
+    monkeypatch.setattr(rec, 'get_client', lambda: s3)
+    return s3
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    cache = RecCache(str(tmp_path / 'cache'), 10 * 1024 ** 2)
+    monkeypatch.setattr(rec, 'get_cache', lambda: cache)
+    return cache
+
+
+def load(tmp_path):
+    return Rec('recs/a.wav', str(tmp_path) + '/', 'bucket', logs=False)
+
+
+def test_a_recording_takes_one_request(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(rec, 'get_cache', lambda: None)
+    r = load(tmp_path)
+    assert r.status == 'HasAudioData' and r.sample_rate == 16000 and r.samples == 8000
+    assert s3.requests == ['get', 'read', 'close']
+
+
+def test_a_cache_hit_does_not_read_the_body(s3, cache, tmp_path):
+    first = load(tmp_path)
+    assert not first.cacheHit
+    assert s3.requests == ['get', 'read', 'close']
+    s3.requests = []
+    second = load(tmp_path)
+    assert second.cacheHit and second.status == 'HasAudioData'
+    numpy.testing.assert_array_equal(second.original, first.original)
+    # the etag came with the response, its body was closed unread
+    assert s3.requests == ['get', 'close']
+
+
+def test_a_reuploaded_recording_misses_the_cache(s3, cache, tmp_path):
+    load(tmp_path)
+    s3.etag = '"v2"'
+    s3.requests = []
+    r = load(tmp_path)
+    assert not r.cacheHit and r.etag == '"v2"'
+    assert s3.requests == ['get', 'read', 'close']
+
+
+def test_a_head_request_when_asked_for(s3, cache, tmp_path, monkeypatch):
+    monkeypatch.setitem(reccache.config, 'cache_head', True)
+    load(tmp_path)
+    assert s3.requests == ['head', 'get', 'read', 'close']
+    s3.requests = []
+    assert load(tmp_path).cacheHit
+    assert s3.requests == ['head']
+
+
+def test_a_body_prefetched_in_memory_is_taken(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(rec, 'get_cache', lambda: None)
+    spool = Spool(None, max_bytes=10 * 1024 ** 2)
+    slot = spool.slot()
+    key = slot.reserve(len(s3.data))
+    prefetched = dict(slot.store(key, io.BytesIO(s3.data)), etag=s3.etag, size=len(s3.data))
+    r = Rec('recs/a.wav', str(tmp_path) + '/', 'bucket', logs=False, prefetched=prefetched)
+    assert r.status == 'HasAudioData' and r.samples == 8000
+    assert s3.requests == []
+    with spool.condition:
+        assert spool.used() == 0
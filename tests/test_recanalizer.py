@@ -0,0 +1,105 @@
+import numpy
+import pytest
+import soundfile
+
+import rfm.legacy.a2audio.recanalizer as recanalizer
+from rfm.legacy.a2audio.recanalizer import Recanalizer
+
+
+class FakeRec:
+    "A decoded recording, as Rec leaves it"
+
+    def __init__(self, samples, sample_rate):
+        self.status = 'HasAudioData'
+        self.original = samples
+        self.samples = len(samples)
+        self.sample_rate = sample_rate
+        self.cache = None
+        self.cacheHit = False
+
+
+def recording(sample_rate, seconds=20, seed=0):
+    rng = numpy.random.RandomState(seed)
+    t = numpy.arange(int(sample_rate * seconds)) / float(sample_rate)
+    # chirps in the species band over a noise floor
+    calls = numpy.sin(2 * numpy.pi * (2500 + 500 * numpy.sin(2 * numpy.pi * 0.5 * t)) * t) * (numpy.sin(2 * numpy.pi * 0.2 * t) > 0.5)
+    return 0.3 * calls + 0.05 * rng.normal(size=len(t))
+
+
+def surface(seed=1):
+    # the rows of the 44100Hz frequency table (highest first), -10000 where no roi reached
+    rng = numpy.random.RandomState(seed)
+    surface = rng.uniform(-90, -30, size=(256, 40))
+    surface[:150] = -10000.0
+    surface[215:220, :5] = -10000.0
+    return surface
+
+
+@pytest.fixture
+def streaming(monkeypatch):
+    # small blocks and match runs, so a short recording goes through many of them
+    monkeypatch.setattr(recanalizer, 'STREAM_BLOCK_FRAMES', 30000)
+    monkeypatch.setattr(recanalizer, 'STREAM_MATCH_COLUMNS', 200)
+
+
+def analyze(tmp_path, path, samples, sample_rate, monkeypatch):
+    "(distances of the streamed analysis of the file at path, distances of the analysis of the decoded samples)"
+    monkeypatch.setattr(recanalizer, 'S3RangeFile', lambda bucket, key, block_size, size, etag: open(path, 'rb'))
+    streamed = Recanalizer('recs/a.wav', surface(), 2000.0, 4000.0, str(tmp_path), 'bucket', test=True, modelSampleRate=44100)
+    assert streamed.processStream()
+    assert streamed.status == 'Processed'
+
+    whole = Recanalizer('recs/a.wav', surface(), 2000.0, 4000.0, str(tmp_path), 'bucket', test=True, modelSampleRate=44100)
+    monkeypatch.setattr(whole, 'instanceRec', lambda: setattr(whole, 'rec', FakeRec(samples, sample_rate)))
+    whole.process()
+    assert whole.status == 'Processed'
+    return streamed.distances, whole.distances
+
+
+def test_streamed_distances_equal_the_whole_recording(tmp_path, streaming, monkeypatch):
+    samples = recording(44100)
+    path = str(tmp_path / 'a.wav')
+    soundfile.write(path, samples, 44100, subtype='DOUBLE')
+    streamed, whole = analyze(tmp_path, path, samples, 44100, monkeypatch)
+    assert len(streamed) == len(whole)
+    # matchTemplate computes in float32, matching runs of columns only changes its rounding
+    numpy.testing.assert_allclose(streamed, whole, rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize('sample_rate', [48000, 96000])
+def test_streamed_distances_of_a_resampled_recording(tmp_path, streaming, monkeypatch, sample_rate):
+    samples = recording(sample_rate, seed=sample_rate)
+    path = str(tmp_path / 'a.wav')
+    soundfile.write(path, samples, sample_rate, subtype='DOUBLE')
+    streamed, whole = analyze(tmp_path, path, samples, sample_rate, monkeypatch)
+    assert len(streamed) == len(whole)
+    # resampling in blocks rounds differently, a few spectrogram values may land in the next 8 bit level
+    numpy.testing.assert_allclose(streamed, whole, rtol=0, atol=1e-4)
+
+
+def test_models_sharing_a_streamed_recording_download_it_once(tmp_path, streaming, monkeypatch):
+    samples = recording(44100)
+    path = str(tmp_path / 'a.wav')
+    soundfile.write(path, samples, 44100, subtype='DOUBLE')
+    opened = []
+
+    def range_file(bucket, key, block_size, size, etag):
+        opened.append((key, size, etag))
+        return open(path, 'rb')
+
+    monkeypatch.setattr(recanalizer, 'S3RangeFile', range_file)
+    alone = Recanalizer('recs/a.wav', surface(), 2000.0, 4000.0, str(tmp_path), 'bucket', test=True, modelSampleRate=44100)
+    assert alone.processStream()
+    del opened[:]
+
+    info = {'path': None, 'size': 1234, 'etag': '"e"'}
+    shared = recanalizer.SharedRec('recs/a.wav', str(tmp_path), 'bucket', prefetched=info, analyses=2)
+    models = [Recanalizer('recs/a.wav', surface(), 2000.0, 4000.0, str(tmp_path), 'bucket', test=True,
+                          modelSampleRate=44100, shared=shared) for _ in range(2)]
+    for model in models:
+        assert model.processStream()
+        assert model.status == 'Processed'
+        numpy.testing.assert_array_equal(model.distances, alone.distances)
+    assert opened == [('recs/a.wav', 1234, '"e"')]
+    shared.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['a.wav']
@@ -0,0 +1,22 @@
+import numpy
+import pytest
+
+from rfm.legacy.a2audio.filters.resample_poly_filter import resample_poly_filter, resample_poly_filter_blocks
+
+
+@pytest.mark.parametrize('rate', [48000, 22050, 96000])
+@pytest.mark.parametrize('block_size', [1000, 4096, 65536, 300000])
+def test_blocks_equal_the_whole_signal(rate, block_size):
+    rng = numpy.random.RandomState(rate)
+    data = rng.normal(size=rate * 2 + 777)
+    blocks = (data[b:(b + block_size)] for b in range(0, len(data), block_size))
+    streamed = numpy.concatenate(list(resample_poly_filter_blocks(blocks, rate, 44100)))
+    whole = resample_poly_filter(data, rate, 44100)
+    assert streamed.shape == whole.shape
+    numpy.testing.assert_allclose(streamed, whole, rtol=0, atol=1e-12)
+
+
+def test_a_signal_shorter_than_the_filter():
+    data = numpy.random.RandomState(0).normal(size=500)
+    streamed = numpy.concatenate(list(resample_poly_filter_blocks(iter([data[:200], data[200:]]), 48000, 44100)))
+    numpy.testing.assert_allclose(streamed, resample_poly_filter(data, 48000, 44100), rtol=0, atol=1e-12)
@@ -0,0 +1,145 @@
+import threading
+import time
+
+import pytest
+
+import rfm.legacy.results as results
+from rfm.legacy.results import ResultSink, vector_csv
+
+
+class FakeConnection:
+    def __init__(self):
+        self.rollbacks = 0
+
+    def ping(self, reconnect=False):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeLog:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, message):
+        self.lines.append(message)
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    "The result batches, error batches and uploads the sink writes, and what makes them fail"
+    stored = {'results': [], 'errors': [], 'uploads': {}, 'failing_rows': set(), 'failing_uploads': False}
+
+    def insert_classification_results(db, rows):
+        if any(row[1] in stored['failing_rows'] for row in rows):
+            raise RuntimeError('insert failed')
+        stored['results'].append(list(rows))
+
+    def upload_fileobj(fileobj, key):
+        if stored['failing_uploads']:
+            raise RuntimeError('upload failed')
+        stored['uploads'][key] = fileobj.read()
+
+    monkeypatch.setattr(results, 'insert_classification_results', insert_classification_results)
+    monkeypatch.setattr(results, 'insert_rec_errors', lambda db, rows: stored['errors'].append(list(rows)))
+    monkeypatch.setattr(results, 'upload_fileobj', upload_fileobj)
+    return stored
+
+
+def test_results_are_written_in_batches(stored):
+    checkpoints = []
+    with ResultSink(FakeConnection(), 9, 'sp', 'st', batch_size=3, upload_threads=1,
+                    checkpoint=lambda rows: checkpoints.append(len(rows))) as sink:
+        for rec_id in range(7):
+            sink.add_result(rec_id, rec_id % 2, 0.5)
+        assert [len(batch) for batch in stored['results']] == [3, 3]
+    assert [len(batch) for batch in stored['results']] == [3, 3, 1]
+    assert checkpoints == [3, 3, 1]
+    assert stored['results'][0][1] == (9, 1, 'sp', 'st', 1, 0.5)
+    assert stored['errors'] == []
+
+
+def test_errors_are_written_in_batches(stored):
+    with ResultSink(FakeConnection(), 9, 'sp', 'st', batch_size=2, upload_threads=1) as sink:
+        for rec_id in range(5):
+            sink.add_error(rec_id, 'error {}'.format(rec_id))
+        assert [len(batch) for batch in stored['errors']] == [2, 2]
+    assert [len(batch) for batch in stored['errors']] == [2, 2, 1]
+    assert stored['errors'][2] == [(4, 9, 'error 4')]
+
+
+def test_a_failed_batch_is_written_row_by_row(stored):
+    stored['failing_rows'].add(2)
+    db = FakeConnection()
+    log = FakeLog()
+    with ResultSink(db, 9, 'sp', 'st', batch_size=4, upload_threads=1, log=log) as sink:
+        for rec_id in range(4):
+            sink.add_result(rec_id, 1, 0.5)
+    # the batch failed, its rows but the failing one are stored one at a time
+    assert stored['results'] == [[(9, 0, 'sp', 'st', 1, 0.5)], [(9, 1, 'sp', 'st', 1, 0.5)], [(9, 3, 'sp', 'st', 1, 0.5)]]
+    assert db.rollbacks == 2
+    # the failing row is reported as an error of its recording
+    assert [(rec_id, job_id) for [(rec_id, job_id, error)] in stored['errors']] == [(2, 9)]
+    assert 'insert failed' in stored['errors'][0][0][2]
+    assert len(log.lines) == 1 and 'job #9' in log.lines[0]
+
+
+def test_vectors_are_uploaded(stored):
+    with ResultSink(FakeConnection(), 9, 'sp', 'st', batch_size=10, upload_threads=2) as sink:
+        for rec_id in range(5):
+            sink.upload_vector('vectors/{}'.format(rec_id), [rec_id, 0.5], rec_id)
+    assert stored['uploads'] == {'vectors/{}'.format(k): vector_csv([k, 0.5]) for k in range(5)}
+
+
+def test_failed_uploads_release_their_slot(stored):
+    stored['failing_uploads'] = True
+    sink = ResultSink(FakeConnection(), 9, 'sp', 'st', batch_size=10, upload_threads=1)
+
+    def upload():
+        # twice the 2 * upload_threads slots, a slot that is not released blocks this for good
+        for rec_id in range(4):
+            sink.upload_vector('vectors/{}'.format(rec_id), [rec_id], rec_id)
+
+    uploader = threading.Thread(target=upload, daemon=True)
+    uploader.start()
+    uploader.join(5)
+    assert not uploader.is_alive()
+    sink.close()
+    assert stored['uploads'] == {}
+    assert sorted(rec_id for batch in stored['errors'] for (rec_id, job_id, error) in batch) == [0, 1, 2, 3]
+
+
+def test_discarding_writes_nothing_more(stored, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    uploaded = []
+
+    def upload_fileobj(fileobj, key):
+        started.set()
+        release.wait(5)
+        uploaded.append(key)
+
+    monkeypatch.setattr(results, 'upload_fileobj', upload_fileobj)
+    sink = ResultSink(FakeConnection(), 9, 'sp', 'st', batch_size=10, upload_threads=1)
+    for rec_id in range(2):
+        sink.upload_vector('vectors/{}'.format(rec_id), [rec_id], rec_id)
+        sink.add_result(rec_id, 1, 0.5)
+    sink.add_error(7, 'error 7')
+    assert started.wait(5)
+    closer = threading.Thread(target=sink.close, args=(True,), daemon=True)
+    closer.start()
+    # the upload in progress finishes once the sink is closing
+    while not sink.discarding:
+        time.sleep(0.01)
+    release.set()
+    closer.join(5)
+    assert not closer.is_alive()
+    # only the upload in progress when the sink was closed went through
+    assert uploaded == ['vectors/0']
+    assert stored['results'] == [] and stored['errors'] == []
+
+
+def test_sizes_must_be_positive():
+    with pytest.raises(ValueError):
+        ResultSink(FakeConnection(), 9, 'sp', 'st', batch_size=-1)
@@ -0,0 +1,49 @@
+import numpy
+import pytest
+from skimage.metrics import structural_similarity
+
+from rfm.legacy.a2audio.slidingssim import sliding_ssim
+
+
+def ssim_loop(spec, template, offsets, win_size):
+    "The per-offset loop Recanalizer.featureVector ran before sliding_ssim"
+    columns = template.shape[1]
+    return [structural_similarity(numpy.copy(spec[:, j:(j + columns)]), template, win_size=win_size, data_range=2)
+            for j in offsets]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_the_skimage_loop(seed):
+    rng = numpy.random.RandomState(seed)
+    rows = rng.randint(7, 40)
+    columns = rng.randint(7, 60)
+    spec = rng.uniform(-120, 0, size=(rows, columns + rng.randint(1, 400)))
+    # a template cut from the spectrogram, so some offsets match closely
+    start = rng.randint(0, spec.shape[1] - columns + 1)
+    template = spec[:, start:(start + columns)] + rng.normal(0, 5, size=(rows, columns))
+    win_size = rng.choice([3, 5, 7])
+    offsets = range(0, spec.shape[1] - columns, rng.choice([1, 4, 32]))
+    numpy.testing.assert_allclose(sliding_ssim(spec, template, offsets, win_size=win_size),
+                                  ssim_loop(spec, template, offsets, win_size), rtol=0, atol=1e-12)
+
+
+def test_constant_windows():
+    spec = numpy.zeros((9, 50))
+    spec[:, 20:30] = 1.0
+    template = numpy.ones((9, 10))
+    offsets = range(0, 40)
+    numpy.testing.assert_allclose(sliding_ssim(spec, template, offsets), ssim_loop(spec, template, offsets, 7),
+                                  rtol=0, atol=1e-12)
+
+
+def test_no_offsets():
+    assert len(sliding_ssim(numpy.zeros((7, 10)), numpy.zeros((7, 10)), range(0))) == 0
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        sliding_ssim(numpy.zeros((7, 20)), numpy.zeros((8, 10)), [0])
+    with pytest.raises(ValueError):
+        sliding_ssim(numpy.zeros((7, 20)), numpy.zeros((7, 10)), [0], win_size=4)
+    with pytest.raises(ValueError):
+        sliding_ssim(numpy.zeros((7, 20)), numpy.zeros((7, 10)), [11])